@@ -1,6 +1,8 @@
+import datetime
 import json
 import io
 import time
+import urllib.request
 import uuid
 import boto3
 import botocore
@@ -10,6 +12,8 @@ from concurrency import concurrent_func
 class Aws:
     s3_clients = None
     lambda_clients = None
+    publish_s3_clients = None
+    publish_lambda_clients = None
     cloudfront_client = None
     signer_client = None
     ssm_client = None
@@ -46,6 +50,19 @@ class Aws:
         self.lambda_clients = {
             region: boto3.client('lambda', region_name=region, config=client_config) for region in self.regions
         }
+        # Separate clients for publishing to each region, which make fewer attempts per call
+        # since failed publications are retried by the publish queue
+        publish_client_config = botocore.config.Config(
+            retries=dict(
+                max_attempts=Constants.REGION_PUBLISH_CLIENT_MAX_ATTEMPTS
+            )
+        )
+        self.publish_s3_clients = {
+            region: boto3.client('s3', region_name=region, config=publish_client_config) for region in self.regions
+        }
+        self.publish_lambda_clients = {
+            region: boto3.client('lambda', region_name=region, config=publish_client_config) for region in self.regions
+        }
         self.cloudfront_client = boto3.client('cloudfront', region_name=Constants.PRIMARY_REGION)
         self.signer_client = boto3.client('signer', region_name=Constants.PRIMARY_REGION)
         self.ssm_client = boto3.client('ssm', region_name=Constants.PRIMARY_REGION)
@@ -130,6 +147,15 @@ class Aws:
         return has_public_policy, statements_to_remove, existing_layer['Content']
 
 
+    # Downloads the content of a published layer version to a file
+    def download_layer_version(self, region, layer_name, version, path):
+        existing_layer = self.lambda_clients[region].get_layer_version(
+            LayerName=layer_name,
+            VersionNumber=version
+        )
+        urllib.request.urlretrieve(existing_layer['Content']['Location'], path)
+
+
     # Adds a public policy to a Lambda Layer
     def create_public_policy(self, region, layer_name, version):
         return self.lambda_clients[region].add_layer_version_permission(
@@ -150,131 +176,184 @@ class Aws:
         )
     
 
-    # Creates a Lambda layer, signs it, and deploys it to all supported regions
-    def deploy_layer(self, layer_config, regions_to_publish):
+    # Creates a Lambda layer, signs it, and deploys it to all supported regions. Any stages that
+    # were completed by a previous run (according to the journal) are skipped. Returns a list of
+    # the regions that the layer couldn't be published to.
+    def deploy_layer(self, layer_config, regions_to_publish, journal, publish_queue):
         # If there are no publications to be done, exit
         if len(regions_to_publish) == 0:
-            return
-
-        s3_object = f'unsigned/{layer_config['name']}/{str(uuid.uuid4())}.zip'
+            return []
 
+        checkpoint = journal.get(layer_config)
         primary_region_bucket_name = self.artifact_bucket_names[Constants.PRIMARY_REGION]
 
-        # Upload the layer to the regional bucket
-        print(f'Uploading unsigned deployment artifact for {layer_config['name']}')
-        self.s3_clients[Constants.PRIMARY_REGION].upload_file(
-            layer_config['archive_path'], primary_region_bucket_name, s3_object)
-
-        print('Unsigned artifact uploaded. Starting signing job...')
-        request_token = str(uuid.uuid4())
-        resp = self.signer_client.start_signing_job(
-            source={
-                's3': {
-                    'bucketName': primary_region_bucket_name,
-                    'key': s3_object,
-                    'version': 'null',
-                }
-            },
-            destination={
-                's3': {
-                    'bucketName': primary_region_bucket_name,
-                    'prefix': 'signed/'
-                }
-            },
-            profileName=Constants.SIGNING_PROFILE_NAME,
-            clientRequestToken=request_token,
-        )
-        signing_job_id = resp['jobId']
-        print(f'Signing job created ({signing_job_id}). Waiting for it to complete...')
+        uploaded = False
+        if 'build' in checkpoint:
+            s3_object = checkpoint['build']['s3_key']
+            print(f'Using unsigned deployment artifact for {layer_config['name']} from checkpoint')
+        else:
+            s3_object = f'unsigned/{layer_config['name']}/{str(uuid.uuid4())}.zip'
+
+            # Upload the layer to the regional bucket
+            print(f'Uploading unsigned deployment artifact for {layer_config['name']}')
+            self.s3_clients[Constants.PRIMARY_REGION].upload_file(
+                layer_config['archive_path'], primary_region_bucket_name, s3_object)
+            journal.record(layer_config, 'build', {
+                'archive_sha256': layer_config['archive_sha256'],
+                's3_bucket': primary_region_bucket_name,
+                's3_key': s3_object,
+                'optimize_report': layer_config['optimize_report'],
+            })
+            uploaded = True
 
         signed_object_key = None
+        signing = checkpoint.get('signing')
+        if signing is not None:
+            if signing['signed_s3_key'] is not None:
+                signed_object_key = signing['signed_s3_key']
+                print(f'Using signed deployment artifact for {layer_config['name']} from checkpoint')
+            else:
+                # A previous run started a signing job but stopped before it completed. If it
+                # failed, a new one is started.
+                print(f'Resuming signing job {signing['job_id']} for {layer_config['name']} from checkpoint...')
+                try:
+                    signed_object_key = self._wait_for_signing_job(signing['job_id'])
+                except RuntimeError as e:
+                    print(e)
+
+        if signed_object_key is None:
+            if uploaded:
+                print('Unsigned artifact uploaded. Starting signing job...')
+            else:
+                print(f'Starting signing job for {layer_config['name']}...')
+            request_token = str(uuid.uuid4())
+            resp = self.signer_client.start_signing_job(
+                source={
+                    's3': {
+                        'bucketName': primary_region_bucket_name,
+                        'key': s3_object,
+                        'version': 'null',
+                    }
+                },
+                destination={
+                    's3': {
+                        'bucketName': primary_region_bucket_name,
+                        'prefix': 'signed/'
+                    }
+                },
+                profileName=Constants.SIGNING_PROFILE_NAME,
+                clientRequestToken=request_token,
+            )
+            signing_job_id = resp['jobId']
+            journal.record(layer_config, 'signing', {
+                'job_id': signing_job_id,
+                'signed_s3_key': None,
+            })
+            print(f'Signing job created ({signing_job_id}). Waiting for it to complete...')
+            try:
+                signed_object_key = self._wait_for_signing_job(signing_job_id)
+            except RuntimeError as e:
+                # Only this layer fails, the other layers carry on building and publishing
+                print(e)
+                return [
+                    {
+                        'layer_name': layer_config['name'],
+                        'region': region,
+                        'attempts': 1,
+                        'error': str(e),
+                    }
+                    for region in regions_to_publish
+                ]
+            journal.record(layer_config, 'signing', {
+                'job_id': signing_job_id,
+                'signed_s3_key': signed_object_key,
+            })
+
+        # Hand the publication to each region off to the shared publish queue, so the build worker
+        # is free for the next layer. Failed publications are retried by the queue.
+        for region in regions_to_publish:
+            publish_queue.submit((layer_config['name'], region), {
+                'region': region,
+                'layer_config': layer_config,
+                'signed_s3_bucket': primary_region_bucket_name,
+                'signed_s3_key': signed_object_key,
+                'progress': {},
+            })
+        return []
+
+
+    # Waits for a signing job to complete and returns the key of the signed object, or raises
+    # an error if the job failed
+    def _wait_for_signing_job(self, signing_job_id):
         while True:
             resp = self.signer_client.describe_signing_job(
                 jobId=signing_job_id
             )
             status = resp['status']
             if status == 'Succeeded':
-                signed_object_key = resp['signedObject']['s3']['key']
-                break
+                print(f'Signing job {signing_job_id} complete')
+                return resp['signedObject']['s3']['key']
             elif status == 'InProgress':
                 time.sleep(1)
                 continue
             else:
                 raise RuntimeError(
-                    f'Signing job failed: {resp['statusReason']}')
-        print(f'Signing job {signing_job_id} complete')
-
-        # Determine which regions need the layer to be published
-        publications = {
-            region: {
-                'region': region,
-                'layer_config': layer_config,
-                'signed_s3_bucket': primary_region_bucket_name,
-                'signed_s3_key': signed_object_key,
-            }
-            for region in regions_to_publish
-        }
-        # Concurrently publish to each region
-        concurrent_func(None, self._deploy_layer_to_region, publications, expand_input=True)
-        return
+                    f'Signing job {signing_job_id} failed: {resp['statusReason']}')
     
 
-    # This deploys a signed layer zip file from S3 to a Lambda Layer in a given region
-    def _deploy_layer_to_region(self, region, layer_config, signed_s3_bucket, signed_s3_key):
-        # Copy the signed artifact to the regional bucket
-        print(f'Copying signed deployment artifact for {layer_config['name']} to {region}')
-        self.s3_clients[region].copy(
-            CopySource={
-                'Bucket': signed_s3_bucket,
-                'Key': signed_s3_key,
-            },
-            Bucket=self.artifact_bucket_names[region],
-            Key=signed_s3_key,
-            SourceClient=self.s3_clients[Constants.PRIMARY_REGION]
-        )
+    # This deploys a signed layer zip file from S3 to a Lambda Layer in a given region. The progress
+    # dict is kept between retries, so a retry doesn't publish a second version of the layer.
+    def deploy_layer_to_region(self, region, layer_config, signed_s3_bucket, signed_s3_key, progress):
+        client = self.publish_lambda_clients[region]
+        publish_response = progress.get('publish_response')
+        if publish_response is None:
+            # Copy the signed artifact to the regional bucket
+            print(f'Copying signed deployment artifact for {layer_config['name']} to {region}')
+            self.publish_s3_clients[region].copy(
+                CopySource={
+                    'Bucket': signed_s3_bucket,
+                    'Key': signed_s3_key,
+                },
+                Bucket=self.artifact_bucket_names[region],
+                Key=signed_s3_key,
+                SourceClient=self.publish_s3_clients[Constants.PRIMARY_REGION]
+            )
+
+            print(f'Publishing layer for {layer_config['name']} in {region}')
+            publish_response = client.publish_layer_version(
+                LayerName=layer_config['name'],
+                Description=json.dumps(
+                    layer_config['description'], separators=(',', ':')),
+                Content={
+                    'S3Bucket': self.artifact_bucket_names[region],
+                    'S3Key': signed_s3_key,
+                },
+                CompatibleRuntimes=[
+                    layer_config['runtime']
+                ],
+                LicenseInfo=Constants.LICENCE_URL
+            )
+            publish_response['LayerName'] = layer_config['name']
+            publish_response['region'] = region
+            progress['publish_response'] = publish_response
 
-        print(f'Publishing layer for {layer_config['name']} in {region}')
-        publish_response = self.lambda_clients[region].publish_layer_version(
-            LayerName=layer_config['name'],
-            Description=json.dumps(
-                layer_config['description'], separators=(',', ':')),
-            Content={
-                'S3Bucket': self.artifact_bucket_names[region],
-                'S3Key': signed_s3_key,
-            },
-            CompatibleRuntimes=[
-                layer_config['runtime']
-            ],
-            LicenseInfo=Constants.LICENCE_URL
-        )
-        publish_response['LayerName'] = layer_config['name']
-        publish_response['region'] = region
         print(f'Adding public permission to {layer_config['name']} in {region}')
-        self.lambda_clients[region].add_layer_version_permission(
-            LayerName=layer_config['name'],
-            VersionNumber=publish_response['Version'],
-            StatementId=Constants.PERMISSION_STATEMENT_ID,
-            Action=Constants.PERMISSION_ACTION,
-            Principal=Constants.PERMISSION_PRINCIPAL,
-        )
+        try:
+            client.add_layer_version_permission(
+                LayerName=layer_config['name'],
+                VersionNumber=publish_response['Version'],
+                StatementId=Constants.PERMISSION_STATEMENT_ID,
+                Action=Constants.PERMISSION_ACTION,
+                Principal=Constants.PERMISSION_PRINCIPAL,
+            )
+        except client.exceptions.ResourceConflictException:
+            # A previous attempt already added the permission
+            pass
         print(f'All operations complete for {layer_config['name']} in {region}')
 
         layer_config['regional'][region] = publish_response
     
 
-    # This uploads the metadata file for a Layer to the S3 metadata bucket
-    def upload_s3_metadata_file(self, path, metadata):
-        self.s3_clients[Constants.PRIMARY_REGION].upload_fileobj(
-            io.BytesIO(json.dumps(metadata, separators=(',', ':')).encode()),
-            Constants.METADATA_BUCKET,
-            path,
-            ExtraArgs={
-                'ContentType': 'application/json',
-            }
-        )
-        return None
-
-
     # Invalidates the metadata CloudFront distribution
     def invalidate_metadata_cloudfront(self):
         r = self.cloudfront_client.create_invalidation(
@@ -304,3 +383,135 @@ class Aws:
                 continue
             else:
                 raise RuntimeError(f'Invalidation failed: {status}')
+
+
+    # This uploads an encoded metadata file to the S3 metadata bucket. S3 (and CloudFront) serve it
+    # with an ETag, so clients can revalidate it with conditional requests once it expires.
+    def upload_s3_metadata_file(self, path, body, cache_control, content_type='application/json'):
+        self.s3_clients[Constants.PRIMARY_REGION].upload_fileobj(
+            io.BytesIO(body),
+            Constants.METADATA_BUCKET,
+            path,
+            ExtraArgs={
+                'ContentType': content_type,
+                'CacheControl': cache_control,
+            }
+        )
+        return None
+
+
+    # Downloads and decodes a metadata file from the S3 metadata bucket, or returns None if it doesn't exist
+    def get_s3_metadata_file(self, path):
+        client = self.s3_clients[Constants.PRIMARY_REGION]
+        try:
+            resp = client.get_object(
+                Bucket=Constants.METADATA_BUCKET,
+                Key=path
+            )
+        except client.exceptions.NoSuchKey:
+            return None
+        return json.loads(resp['Body'].read())
+
+
+    # Deletes the immutable metadata objects that aren't in a set of referenced keys, and that were
+    # uploaded longer ago than the retention period. Returns the number of objects deleted.
+    def delete_unreferenced_metadata_objects(self, referenced_keys):
+        client = self.s3_clients[Constants.PRIMARY_REGION]
+        paginator = client.get_paginator('list_objects_v2').paginate(
+            Bucket=Constants.METADATA_BUCKET,
+            Prefix=Constants.METADATA_OBJECTS_PREFIX
+        )
+        cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(
+            seconds=Constants.METADATA_OBJECTS_RETENTION)
+        num_deleted = 0
+        for page in paginator:
+            objects = [
+                {'Key': obj['Key']} for obj in page.get('Contents', [])
+                if obj['Key'] not in referenced_keys and obj['LastModified'] < cutoff
+            ]
+            if len(objects) > 0:
+                client.delete_objects(
+                    Bucket=Constants.METADATA_BUCKET,
+                    Delete={
+                        'Objects': objects,
+                        'Quiet': True
+                    }
+                )
+                num_deleted += len(objects)
+        return num_deleted
+
+
+    # Downloads and decodes a JSON object from the primary region's artifact bucket, or returns None if it doesn't exist
+    def _get_artifact_json(self, key):
+        client = self.s3_clients[Constants.PRIMARY_REGION]
+        try:
+            resp = client.get_object(
+                Bucket=self.artifact_bucket_names[Constants.PRIMARY_REGION],
+                Key=key
+            )
+        except client.exceptions.NoSuchKey:
+            return None
+        return json.loads(resp['Body'].read())
+
+
+    # Encodes and uploads a JSON object to the primary region's artifact bucket
+    def _put_artifact_json(self, key, data):
+        self.s3_clients[Constants.PRIMARY_REGION].put_object(
+            Bucket=self.artifact_bucket_names[Constants.PRIMARY_REGION],
+            Key=key,
+            Body=json.dumps(data, separators=(',', ':'), default=str).encode(),
+            ContentType='application/json',
+        )
+
+
+    # Downloads the checkpoint journal record for a layer, or returns None if it doesn't exist
+    def get_checkpoint(self, layer_name):
+        return self._get_artifact_json(f'{Constants.CHECKPOINT_PREFIX}{layer_name}.json')
+
+
+    # Uploads the checkpoint journal record for a layer
+    def put_checkpoint(self, layer_name, record):
+        self._put_artifact_json(f'{Constants.CHECKPOINT_PREFIX}{layer_name}.json', record)
+
+
+    # Downloads the historical build durations (in seconds) of each layer
+    def get_build_costs(self):
+        costs = self._get_artifact_json(Constants.BUILD_COSTS_OBJECT)
+        if costs is None:
+            return {}
+        return costs
+
+
+    # Uploads the historical build durations (in seconds) of each layer
+    def put_build_costs(self, costs):
+        self._put_artifact_json(Constants.BUILD_COSTS_OBJECT, costs)
+
+
+    # Downloads an inventory snapshot, or returns None if it doesn't exist
+    def get_inventory_snapshot(self):
+        return self._get_artifact_json(Constants.INVENTORY_SNAPSHOT_OBJECT)
+
+
+    # Uploads an inventory snapshot
+    def put_inventory_snapshot(self, snapshot):
+        self._put_artifact_json(Constants.INVENTORY_SNAPSHOT_OBJECT, snapshot)
+
+
+    # Deletes all checkpoint journal records
+    def delete_checkpoints(self):
+        client = self.s3_clients[Constants.PRIMARY_REGION]
+        bucket_name = self.artifact_bucket_names[Constants.PRIMARY_REGION]
+        paginator = client.get_paginator('list_objects_v2').paginate(
+            Bucket=bucket_name,
+            Prefix=Constants.CHECKPOINT_PREFIX
+        )
+        for page in paginator:
+            objects = [{'Key': obj['Key']} for obj in page.get('Contents', [])]
+            if len(objects) > 0:
+                client.delete_objects(
+                    Bucket=bucket_name,
+                    Delete={
+                        'Objects': objects,
+                        'Quiet': True
+                    }
+                )
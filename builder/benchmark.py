@@ -0,0 +1,191 @@
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import zipfile
+from config import Constants
+from logs import BuildLog
+
+# This script is run in the benchmark container. It imports the modules in a fresh
+# interpreter for each iteration, so that every measurement is a cold import.
+RUNNER_SCRIPT = '''
+import subprocess
+import sys
+
+iterations = int(sys.argv[1])
+import_script = sys.argv[2]
+modules = sys.argv[3:]
+for _ in range(iterations):
+    subprocess.run([sys.executable, '-c', import_script, *modules], check=True)
+'''
+
+# This script is run by the fresh interpreter for each iteration. It prints the
+# measurements as a single JSON line.
+IMPORT_SCRIPT = '''
+import importlib
+import json
+import resource
+import sys
+import time
+
+start = time.perf_counter()
+for module in sys.argv[1:]:
+    importlib.import_module(module)
+import_time = time.perf_counter() - start
+print(json.dumps({
+    'import_time': import_time,
+    # On Linux, ru_maxrss is in KiB
+    'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+}))
+'''
+
+
+# Finds the top-level modules in a layer archive, by looking for packages and
+# modules directly within the layer target directory
+def get_top_level_modules(archive, layer_target_directory):
+    prefix = f'{layer_target_directory.strip('/')}/'
+    modules = set()
+    for name in archive.namelist():
+        if not name.startswith(prefix):
+            continue
+        parts = name[len(prefix):].split('/')
+        if len(parts) == 2 and parts[1] == '__init__.py':
+            module = parts[0]
+        elif len(parts) == 1 and parts[0].endswith('.py'):
+            module = parts[0][0:-3]
+        else:
+            continue
+        # Skip private modules, they're imported by the public ones if they're needed
+        if module.startswith('_') or not module.isidentifier():
+            continue
+        modules.add(module)
+    return sorted(modules)
+
+
+# Returns the Docker platform of the host, or None if it isn't one that layers are built for
+def get_host_platform():
+    machine = platform.machine().lower()
+    # Different operating systems report the same architectures with different names
+    machine = {'amd64': 'x86_64', 'aarch64': 'arm64'}.get(machine, machine)
+    return Constants.ARCHITECTURE_LOOKUP.get(machine)
+
+
+# Returns whether a layer needs to be benchmarked: if it has a benchmark config, and the results
+# carried forward from the previous metadata for its published versions are missing or were
+# measured with a different config
+def needs_benchmark(layer_config, previous_benchmarks):
+    if layer_config['benchmark'] is None:
+        return False
+    previous_results = [
+        previous_benchmarks.get(regional['LayerVersionArn'])
+        for regional in layer_config['regional'].values()
+        if regional is not None
+    ]
+    return len(previous_results) == 0 or any(
+        results is None or results.get('config') != layer_config['benchmark'] for results in previous_results)
+
+
+# Benchmarks each layer that needs it, one at a time, once all of the builds are complete so that
+# the measurements aren't skewed by builds running at the same time. Layers that weren't built by
+# this run are downloaded from a region they're published in, if download is set.
+def benchmark_layers(aws, layer_configs, previous_benchmarks, download):
+    host_platform = get_host_platform()
+    for layer_config in layer_configs.values():
+        if not needs_benchmark(layer_config, previous_benchmarks):
+            continue
+        if not layer_config['runtime'].startswith('python'):
+            print(f'Skipping benchmark for {layer_config['name']}: only Python runtimes are supported')
+            continue
+        # Layers for other architectures would run under emulation, so their results would be meaningless
+        if layer_config['platform'] != host_platform:
+            print(f'Skipping benchmark for {layer_config['name']}: {layer_config['platform']} layers can\'t be benchmarked natively on this host')
+            continue
+
+        downloaded = False
+        if not os.path.exists(layer_config['archive_path']):
+            regions = [region for region, regional in layer_config['regional'].items() if regional is not None]
+            if not download or len(regions) == 0:
+                continue
+            region = Constants.PRIMARY_REGION if Constants.PRIMARY_REGION in regions else regions[0]
+            print(f'Downloading layer {layer_config['name']} from {region} to benchmark it')
+            try:
+                aws.download_layer_version(
+                    region, layer_config['name'], layer_config['regional'][region]['Version'], layer_config['archive_path'])
+            except Exception as e:
+                # Like a failed benchmark, this shouldn't prevent the metadata from being uploaded
+                print(f'Failed to download layer {layer_config['name']} to benchmark it: {type(e).__name__}: {e}')
+                continue
+            downloaded = True
+
+        print(f'Benchmarking layer {layer_config['name']}...')
+        try:
+            with BuildLog(layer_config['name'], layer_config['benchmark_log_path']) as log:
+                benchmark_layer(layer_config, log)
+        finally:
+            if downloaded:
+                os.remove(layer_config['archive_path'])
+
+
+# Extracts a built layer, then measures the time and memory it takes to import its
+# modules in the Lambda base image that matches the layer's runtime. The output of the
+# benchmark is written to the given log.
+def benchmark_layer(layer_config, log):
+    benchmark_config = layer_config['benchmark']
+    runtime = layer_config['runtime']
+
+    with zipfile.ZipFile(layer_config['archive_path'], mode='r') as archive:
+        unzipped_size = sum(info.file_size for info in archive.infolist())
+        modules = benchmark_config.get('modules')
+        if modules is None:
+            modules = get_top_level_modules(
+                archive, layer_config['layer_target_directory'])
+        if len(modules) == 0:
+            log.write('Skipping benchmark: no top-level modules were found')
+            return
+        shutil.rmtree(layer_config['benchmark_path'], ignore_errors=True)
+        archive.extractall(layer_config['benchmark_path'])
+
+    iterations = benchmark_config.get('iterations', Constants.BENCHMARK_DEFAULT_ITERATIONS)
+    image = Constants.BENCHMARK_IMAGE.format(version=runtime[len('python'):])
+    mount = Constants.LAYER_MOUNT_DIRECTORY
+    python_path = f'{mount}/python/lib/{runtime}/site-packages:{mount}/python'
+
+    log.write(f'Benchmarking imports of {', '.join(modules)}...')
+    measurements = []
+
+    def on_line(line):
+        # Ignore anything the modules themselves may have printed while being imported
+        if line.startswith('{"import_time"'):
+            measurements.append(json.loads(line))
+
+    try:
+        # Mount the layer read-only, the same way Lambda provides it
+        log.run(['docker', 'run', '--rm', '--platform', layer_config['platform'],
+                 '-v', f'{layer_config['benchmark_path']}:{mount}:ro',
+                 '-e', f'PYTHONPATH={python_path}', '-e', 'PYTHONDONTWRITEBYTECODE=1',
+                 '--entrypoint', 'python3', image, '-c', RUNNER_SCRIPT,
+                 str(iterations), IMPORT_SCRIPT, *modules], on_line=on_line)
+    except subprocess.CalledProcessError as e:
+        # A failed benchmark shouldn't prevent the layer from being deployed, it just won't have results
+        log.write(f'Benchmark failed with exit code {e.returncode}, no results will be recorded')
+        return
+    finally:
+        shutil.rmtree(layer_config['benchmark_path'], ignore_errors=True)
+
+    if len(measurements) == 0:
+        log.write('Benchmark produced no measurements, no results will be recorded')
+        return
+    layer_config['benchmark_results'] = {
+        # The config the results were measured with, so they're measured again if it changes
+        'config': benchmark_config,
+        'modules': modules,
+        'iterations': len(measurements),
+        'import_time_median_ms': round(statistics.median(m['import_time'] for m in measurements) * 1000, 3),
+        'peak_rss': max(m['peak_rss'] for m in measurements),
+        'unzipped_size': unzipped_size,
+    }
+    log.write(f'Benchmark results: median import time {layer_config['benchmark_results']['import_time_median_ms']} ms, '
+              f'peak RSS {layer_config['benchmark_results']['peak_rss'] / 1048576:.1f} MiB, '
+              f'unzipped size {unzipped_size / 1048576:.1f} MiB')
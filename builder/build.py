@@ -2,18 +2,35 @@ import os
 import shutil
 from pathlib import Path
 import json
+import gzip
+import hashlib
 import uuid
 import sys
+import argparse
+import functools
 from aws import Aws
-from concurrency import concurrent_func
+from concurrency import concurrent_func, bounded_concurrent_func, RetryQueue
 from config import Constants
+from journal import Journal
+from inventory import InventorySnapshot
+import benchmark
+import index
 import layers
+import shards
 
 
-def process_existing_layer_data(aws, is_deploy: bool, layer_configs: dict, existing_layers_by_region: dict):
+# When running a single shard, layer_configs only contains the shard's layers, and all_layer_names
+# contains the names of the layers in every shard (so other shards' layers aren't reported as untracked).
+# The policy and content checks are reused from the inventory snapshot for layer versions that were checked recently.
+def process_existing_layer_data(aws, is_deploy: bool, layer_configs: dict, existing_layers_by_region: dict, snapshot, all_layer_names=None):
     # This is for tracking all existing layers that match a desired layer, but
     # are missing a public permission policy.
     existing_layers_needing_policy_check = {}
+    # This is the subset of those that don't have a recent check in the inventory snapshot
+    existing_layers_to_check = {}
+    existing_layer_data = {}
+    # The time that each reused check was originally made
+    reused_checked_at = {}
 
     # Check each unique layer config
     for layer_config in layer_configs.values():
@@ -37,19 +54,28 @@ def process_existing_layer_data(aws, is_deploy: bool, layer_configs: dict, exist
                 if metadata != layer_config['description']:
                     continue
 
-                existing_layers_needing_policy_check[str(uuid.uuid4())] = {
+                input_key = str(uuid.uuid4())
+                existing_layers_needing_policy_check[input_key] = {
                     'region': region,
                     'layer_name': existing_layer['LayerName'],
                     'version': existing_layer['Version']
                 }
 
+                cached_check = snapshot.get_check(region, existing_layer['LayerName'], existing_layer['Version'])
+                if cached_check is not None:
+                    existing_layer_data[input_key] = (
+                        cached_check['has_policy'], cached_check['statements_to_remove'], cached_check['content'])
+                    reused_checked_at[input_key] = cached_check['checked_at']
+                else:
+                    existing_layers_to_check[input_key] = existing_layers_needing_policy_check[input_key]
+
                 layer_regionals[region] = existing_layer
 
-    print('Checking policies for existing layers...')
+    print(f'Checking policies for {len(existing_layers_to_check)} existing layers ({len(existing_layer_data)} reused from the inventory snapshot)...')
     # Check each layer to see if it has an existing public policy. This
     # also populates data about the Content (including signing)
-    existing_layer_data = concurrent_func(
-        100, aws.get_layer, existing_layers_needing_policy_check, expand_input=True)
+    existing_layer_data |= concurrent_func(
+        100, aws.get_layer, existing_layers_to_check, expand_input=True)
 
     # We do this as a dict with unique random keys because the concurrent_func function expects a dict
     all_statements_to_remove = {}
@@ -89,33 +115,95 @@ def process_existing_layer_data(aws, is_deploy: bool, layer_configs: dict, exist
                         create_policy_inputs, expand_input=True)
         print('Done!')
 
+    # Record the checks in the snapshot, reflecting any policy fixes that were just made
+    for input_key, existing_layer_datum in existing_layer_data.items():
+        has_policy, statements_to_remove, content = existing_layer_datum
+        inpt = existing_layers_needing_policy_check[input_key]
+        check = {
+            'version': inpt['version'],
+            'has_policy': has_policy or is_deploy,
+            'statements_to_remove': [] if is_deploy else statements_to_remove,
+            'content': content,
+        }
+        if input_key in reused_checked_at:
+            check['checked_at'] = reused_checked_at[input_key]
+        snapshot.update(inpt['region'], inpt['layer_name'], check)
+
+    if all_layer_names is None:
+        all_layer_names = layer_configs.keys()
     untracked_layers = []
     for region, existing_layers in existing_layers_by_region.items():
         for layer_name, layer in existing_layers.items():
-            if layer_name not in layer_configs:
+            if layer_name not in all_layer_names:
                 untracked_layers.append(layer)
 
     print(f'There are {len(untracked_layers)} untracked layers')
 
 
-# Once everything is built and deployed, this uploads the metadata files to the S3 metadata bucket,
-# then invalidates the CloudFront distribution to ensure the cache is cleared.
-def upload_metadata(aws, layer_configs):
+# Prints a structured report of the regional publications that failed on every attempt, and
+# writes it to a file so it can be collected by CI
+def report_failures(failures, directory):
+    failures = sorted(failures, key=lambda failure: (failure['layer_name'], failure['region']))
+    report_path = f'{directory}/failures.json'
+    with open(report_path, mode='w') as file:
+        json.dump(failures, file, indent=4)
+    print(f'{len(failures)} regional layers failed to build or publish (report written to {report_path}):')
+    print(json.dumps(failures, indent=4))
+
+
+# Benchmarks are only run when a layer is built or its benchmark config has changed, so this finds the
+# benchmark results from the previously uploaded metadata, keyed by layer version ARN, so they can be carried forward.
+def get_previous_benchmarks(aws):
+    previous_benchmarks = {}
+    previous_metadata = aws.get_s3_metadata_file(Constants.METADATA_OBJECT)
+    if previous_metadata is None:
+        return previous_benchmarks
+    for package_config in previous_metadata.values():
+        for version_config in package_config.values():
+            for runtime_config in version_config.values():
+                for architecture_config in runtime_config.values():
+                    for region_config in architecture_config.values():
+                        if region_config.get('benchmark') is not None:
+                            previous_benchmarks[region_config['layer_version_arn']] = region_config['benchmark']
+    return previous_benchmarks
+
+
+# Finds the layers that will need to be built, according to the previously uploaded metadata: those that
+# are missing from a region, or whose description has changed. Unlike the live inventory, the metadata
+# doesn't change while the shards are running, so every shard finds the same layers.
+def get_layers_to_build(aws, layer_configs):
+    previous_descriptions = {}
+    previous_metadata = aws.get_s3_metadata_file(Constants.METADATA_OBJECT)
+    if previous_metadata is not None:
+        for package_config in previous_metadata.values():
+            for version_config in package_config.values():
+                for runtime_config in version_config.values():
+                    for architecture_config in runtime_config.values():
+                        for region, region_config in architecture_config.items():
+                            previous_descriptions[(region_config['layer_name'], region)] = region_config['description']
+
+    layers_to_build = set()
+    for name, layer_config in layer_configs.items():
+        description = json.dumps(layer_config['description'], separators=(',', ':'))
+        for region in aws.regions:
+            if previous_descriptions.get((name, region)) != description:
+                layers_to_build.add(name)
+                break
+    return layers_to_build
+
+
+# Builds the nested package -> version -> runtime -> architecture -> region metadata tree
+# in a single pass over the layer configs
+def build_metadata_tree(layer_configs, previous_benchmarks):
     metadata = {}
     for layer_config in layer_configs.values():
-        if layer_config['package_name'] not in metadata:
-            metadata[layer_config['package_name']] = {}
-        if layer_config['version'] not in metadata[layer_config['package_name']]:
-            metadata[layer_config['package_name']
-                     ][layer_config['version']] = {}
-        if layer_config['runtime'] not in metadata[layer_config['package_name']][layer_config['version']]:
-            metadata[layer_config['package_name']][layer_config['version']
-                                                   ][layer_config['runtime']] = {}
-        if layer_config['architecture'] not in metadata[layer_config['package_name']][layer_config['version']][layer_config['runtime']]:
-            metadata[layer_config['package_name']][layer_config['version']
-                                                   ][layer_config['runtime']][layer_config['architecture']] = {}
+        architecture_metadata = metadata.setdefault(layer_config['package_name'], {}).setdefault(
+            layer_config['version'], {}).setdefault(layer_config['runtime'], {}).setdefault(layer_config['architecture'], {})
         for region, regional in layer_config['regional'].items():
-            metadata[layer_config['package_name']][layer_config['version']][layer_config['runtime']][layer_config['architecture']][region] = {
+            # Skip regions where the layer couldn't be published
+            if regional is None:
+                continue
+            architecture_metadata[region] = {
                 'description': regional['Description'],
                 'license_info': regional['LicenseInfo'],
                 'layer_arn': regional['LayerArn'],
@@ -126,106 +214,325 @@ def upload_metadata(aws, layer_configs):
                 'signing_job_arn': regional['Content'].get('SigningJobArn'),
                 'signing_profile_version_arn': regional['Content'].get('SigningProfileVersionArn'),
                 'source_code_hash': regional['Content']['CodeSha256'],
-                'source_code_size': regional['Content']['CodeSize']
+                'source_code_size': regional['Content']['CodeSize'],
+                # Prefer the results measured by this run (for this layer version, or a new one with the same
+                # Dockerfile), otherwise carry forward the results measured for this exact layer version
+                'benchmark': layer_config['benchmark_results'] if layer_config['benchmark_results'] is not None
+                else previous_benchmarks.get(regional['LayerVersionArn']),
             }
+    return metadata
+
+
+# Encodes a JSON metadata document. Keys are sorted so that the same content always has the same
+# encoding (and hash), regardless of the order in which layers were processed.
+def encode_metadata_document(document):
+    return json.dumps(document, separators=(',', ':'), sort_keys=True).encode()
+
 
-    metadata_files = {}
+# Yields the path, encoded content and content type of each metadata document, one at a time,
+# so that only the encoded documents currently being uploaded are held in memory. The metadata
+# tree itself, and the top-level documents, still grow with the number of layers.
+def generate_metadata_documents(metadata):
     package_base_path = "packages"
     for package_name, package_config in metadata.items():
-        metadata_files[str(uuid.uuid4())] = {
-            'path': f'{package_base_path}/{package_name}.json',
-            'metadata': package_config | {
-                'package': package_name,
-            }
-        }
+        yield f'{package_base_path}/{package_name}.json', encode_metadata_document(package_config | {
+            'package': package_name,
+        }), 'application/json'
         for version, version_config in package_config.items():
-            metadata_files[str(uuid.uuid4())] = {
-                'path': f'{package_base_path}/{package_name}/{version}.json',
-                'metadata': version_config | {
+            yield f'{package_base_path}/{package_name}/{version}.json', encode_metadata_document(version_config | {
+                'package': package_name,
+                'package_version': version,
+            }), 'application/json'
+            for runtime, runtime_config in version_config.items():
+                yield f'{package_base_path}/{package_name}/{version}/{runtime}.json', encode_metadata_document(runtime_config | {
                     'package': package_name,
                     'package_version': version,
-                }
-            }
-            for runtime, runtime_config in version_config.items():
-                metadata_files[str(uuid.uuid4())] = {
-                    'path': f'{package_base_path}/{package_name}/{version}/{runtime}.json',
-                    'metadata': runtime_config | {
+                    'runtime': runtime,
+                }), 'application/json'
+                for architecture, architecture_config in runtime_config.items():
+                    yield f'{package_base_path}/{package_name}/{version}/{runtime}/{architecture}.json', encode_metadata_document(architecture_config | {
                         'package': package_name,
                         'package_version': version,
                         'runtime': runtime,
-                    }
-                }
-                for architecture, architecture_config in runtime_config.items():
-                    metadata_files[str(uuid.uuid4())] = {
-                        'path': f'{package_base_path}/{package_name}/{version}/{runtime}/{architecture}.json',
-                        'metadata': architecture_config | {
+                        'architecture': architecture,
+                    }), 'application/json'
+                    for region, region_config in architecture_config.items():
+                        yield f'{package_base_path}/{package_name}/{version}/{runtime}/{architecture}/{region}.json', encode_metadata_document(region_config | {
                             'package': package_name,
                             'package_version': version,
                             'runtime': runtime,
                             'architecture': architecture,
-                        }
-                    }
-                    for region, region_config in architecture_config.items():
-                        metadata_files[str(uuid.uuid4())] = {
-                            'path': f'{package_base_path}/{package_name}/{version}/{runtime}/{architecture}/{region}.json',
-                            'metadata': region_config | {
-                                'package': package_name,
-                                'package_version': version,
-                                'runtime': runtime,
-                                'architecture': architecture,
-                                'region': region,
-                            }
-                        }
-
-    # Upload the master layers file with all data
-    metadata_files[str(uuid.uuid4())] = {
-        'path': Constants.METADATA_OBJECT,
-        'metadata': metadata
-    }
+                            'region': region,
+                        }), 'application/json'
+
+    # The master layers file with all data
+    yield Constants.METADATA_OBJECT, encode_metadata_document(metadata), 'application/json'
+
+    # A compact SQLite index of all layers, for fast queries after a single download. The compressed
+    # copy has a fixed timestamp, so the same index always has the same hash.
+    index_body = index.generate_index(metadata)
+    yield Constants.METADATA_INDEX_OBJECT, index_body, 'application/vnd.sqlite3'
+    yield Constants.METADATA_COMPRESSED_INDEX_OBJECT, gzip.compress(index_body, mtime=0), 'application/gzip'
+
+
+# Yields the uploads for each metadata document that has changed since the previous manifest,
+# and adds every document to the new manifest. Each document is published under an immutable
+# key named by the hash of its content, and at its usual path with a short TTL.
+def generate_metadata_uploads(documents, previous_documents, manifest_documents):
+    for path, body, content_type in documents:
+        sha256 = hashlib.sha256(body).hexdigest()
+        manifest_documents[path] = {
+            'key': f'{Constants.METADATA_OBJECTS_PREFIX}{sha256}{os.path.splitext(path)[1]}',
+            'sha256': sha256,
+            'size': len(body),
+        }
+        previous_document = previous_documents.get(path)
+        if previous_document is not None and previous_document['sha256'] == sha256:
+            continue
+        yield {
+            'path': path,
+            'key': manifest_documents[path]['key'],
+            'body': body,
+            'content_type': content_type,
+        }
 
-    print(f'Uploading {len(metadata_files)} metadata documents...')
 
-    # Upload all metadata files
-    concurrent_func(
-        100, aws.upload_s3_metadata_file, metadata_files, expand_input=True)
+# Uploads a metadata document under its immutable key and at its usual path
+def upload_metadata_document(aws, path, key, body, content_type):
+    aws.upload_s3_metadata_file(
+        key, body, Constants.METADATA_IMMUTABLE_CACHE_CONTROL, content_type)
+    aws.upload_s3_metadata_file(
+        path, body, Constants.METADATA_MUTABLE_CACHE_CONTROL, content_type)
+
+
+# Returns the name of the package that a metadata document belongs to, or None if it's a top-level document
+def get_document_package(path):
+    if not path.startswith('packages/'):
+        return None
+    package_path = path[len('packages/'):]
+    if '/' in package_path:
+        return package_path.split('/')[0]
+    return package_path.removesuffix('.json')
+
+
+# Returns the documents listed by a manifest and by the package manifests it references. Manifests
+# from before they were split by package list every document directly.
+def get_manifest_documents(aws, manifest):
+    documents = dict(manifest['documents'])
+    for package_manifest_entry in manifest.get('packages', {}).values():
+        package_manifest = aws.get_s3_metadata_file(package_manifest_entry['key'])
+        if package_manifest is not None:
+            documents |= package_manifest['documents']
+    return documents
+
+
+# Uploads the manifest of each package whose documents have changed, and returns the entries for the
+# package manifests to be listed in the top-level manifest
+def upload_package_manifests(aws, manifest_documents, previous_packages):
+    package_documents = {}
+    for path, document in manifest_documents.items():
+        package_name = get_document_package(path)
+        if package_name is not None:
+            package_documents.setdefault(package_name, {})[path] = document
+
+    packages = {}
+    for package_name, documents in package_documents.items():
+        path = Constants.METADATA_PACKAGE_MANIFEST_PATH.format(package=package_name)
+        body = encode_metadata_document({
+            'package': package_name,
+            'documents': documents,
+        })
+        sha256 = hashlib.sha256(body).hexdigest()
+        packages[package_name] = {
+            'path': path,
+            'key': f'{Constants.METADATA_OBJECTS_PREFIX}{sha256}.json',
+            'sha256': sha256,
+            'size': len(body),
+        }
+        previous_package = previous_packages.get(package_name)
+        if previous_package is None or previous_package['sha256'] != sha256:
+            upload_metadata_document(aws, path, packages[package_name]['key'], body, 'application/json')
+    return packages
+
 
-    print('Invalidating CloudFront paths...')
-    aws.invalidate_metadata_cloudfront()
-    print('CloudFront invalidation complete')
+# Once everything is built and deployed, this uploads the metadata files to the S3 metadata bucket.
+# Once the manifest exists, no CloudFront invalidation is needed: documents at mutable paths have a
+# short TTL, and everything else is immutable.
+def upload_metadata(aws, layer_configs):
+    metadata = build_metadata_tree(layer_configs, get_previous_benchmarks(aws))
+
+    # The manifests map each path to its immutable key, so documents that haven't changed since
+    # the previous manifests don't need to be uploaded again
+    previous_manifest = aws.get_s3_metadata_file(Constants.METADATA_MANIFEST_OBJECT)
+    previous_documents = {}
+    previous_packages = {}
+    if previous_manifest is not None:
+        previous_documents = get_manifest_documents(aws, previous_manifest)
+        previous_packages = previous_manifest.get('packages', {})
+    manifest_documents = {}
+
+    # Documents are generated as the upload workers are ready for them, so the encoded documents
+    # don't all have to be held in memory at once (see metadata_benchmark.py for how the peak grows)
+    print('Uploading changed metadata documents...')
+    num_uploaded = bounded_concurrent_func(
+        Constants.METADATA_UPLOAD_WORKERS,
+        functools.partial(upload_metadata_document, aws),
+        generate_metadata_uploads(generate_metadata_documents(metadata), previous_documents, manifest_documents),
+        Constants.METADATA_UPLOAD_MAX_PENDING, expand_input=True)
+    print(f'{num_uploaded} of {len(manifest_documents)} metadata documents had changed')
+
+    # Each package has its own manifest, so clients that only use a few packages only need the small
+    # top-level manifest and the manifests of those packages, rather than an entry for every document.
+    # The package manifests are uploaded after their documents, and the top-level manifest last, so a
+    # manifest never points to documents that haven't been uploaded.
+    print('Uploading metadata manifests...')
+    packages = upload_package_manifests(aws, manifest_documents, previous_packages)
+    aws.upload_s3_metadata_file(
+        Constants.METADATA_MANIFEST_OBJECT,
+        encode_metadata_document({
+            'documents': {
+                path: document for path, document in manifest_documents.items()
+                if get_document_package(path) is None
+            },
+            'packages': packages,
+        }),
+        Constants.METADATA_MUTABLE_CACHE_CONTROL,
+    )
+
+    # Remove the immutable objects that are no longer referenced. Those referenced by the previous
+    # manifests are kept, since clients may still have them cached.
+    referenced_keys = {document['key'] for document in manifest_documents.values()}
+    referenced_keys |= {document['key'] for document in previous_documents.values()}
+    referenced_keys |= {package['key'] for package in packages.values()}
+    referenced_keys |= {package['key'] for package in previous_packages.values()}
+    num_deleted = aws.delete_unreferenced_metadata_objects(referenced_keys)
+    print(f'Deleted {num_deleted} unreferenced metadata objects')
+
+    # Documents uploaded before there was a manifest have no Cache-Control header, so CloudFront may
+    # keep serving them for the distribution's default TTL. Without a previous manifest, every document
+    # was just uploaded again with the header, so a single invalidation is enough to replace them.
+    if previous_manifest is None:
+        print('Invalidating CloudFront paths...')
+        aws.invalidate_metadata_cloudfront()
+        print('CloudFront invalidation complete')
+    print('Metadata upload complete')
+
+
+# Records how long each layer took to build, for balancing layers between shards in future runs
+def update_build_costs(aws, layer_configs):
+    costs = aws.get_build_costs()
+    for name, layer_config in layer_configs.items():
+        if layer_config['build_duration'] is not None:
+            costs[name] = round(layer_config['build_duration'], 1)
+    # Forget about layers that no longer exist
+    aws.put_build_costs({name: cost for name, cost in costs.items() if name in layer_configs})
+
+
+# Once all layers have been published, this uploads the metadata and records the build costs,
+# then reports any regional publications that failed. If none failed, the checkpoint journal
+# is cleared since there's nothing for a future run to resume.
+def finish_deploy(aws, journal, layer_configs, failures, dockerfile_dir):
+    # Publish the metadata for everything that succeeded, even if some regions failed
+    upload_metadata(aws, layer_configs)
+    update_build_costs(aws, layer_configs)
+
+    if len(failures) > 0:
+        report_failures(failures, dockerfile_dir)
+        sys.exit(1)
+
+    journal.clear()
+    print('All builds and publications complete!')
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Builds the public Lambda layers and, optionally, publishes them')
+    parser.add_argument('deploy', nargs='?', default='false',
+                        help='"true" to publish the layers and metadata, otherwise they are only built')
+    parser.add_argument('--fresh', action='store_true',
+                        help='Ignore the checkpoint journal from any previous run that failed, and start over')
+    parser.add_argument('--full-rescan', action='store_true',
+                        help='Check the policy and content of every existing layer, instead of reusing recent checks '
+                        'of the same layer versions from the inventory snapshot')
+    parser.add_argument('--shard', type=shards.parse_shard, metavar='i/N',
+                        help='Only build and publish the i-th of N deterministic partitions of the layers, '
+                        'and write the results for a later --merge instead of uploading the metadata')
+    parser.add_argument('--shard-output', default='shard-output', metavar='DIR',
+                        help='The directory to write the results of a shard to')
+    parser.add_argument('--merge', metavar='DIR',
+                        help='Merge the results of all shards from a directory, then upload the metadata')
+    args = parser.parse_args()
+
     docker_workers = 4
-    is_deploy = len(sys.argv) > 1 and sys.argv[1] == 'true'
+    is_deploy = args.deploy == 'true'
     dockerfile_dir = os.path.join(Path.cwd().resolve(), "dockerfiles")
 
+    if args.merge is not None and (not is_deploy or args.shard is not None):
+        parser.error('--merge can only be used when deploying, and not with --shard')
+
     if os.path.exists(dockerfile_dir):
         shutil.rmtree(dockerfile_dir)
 
     os.makedirs(dockerfile_dir)
     aws = Aws()
+    # The journal is only used when deploying, since validation runs can't write to S3
+    journal = Journal(aws, is_deploy, fresh=args.fresh)
+
+    if args.merge is not None:
+        layer_configs, failures, inventory_checks = shards.read_shard_outputs(args.merge)
+        print(f'Merged results for {len(layer_configs)} layers from all shards')
+        # The snapshot is replaced by the checks from every shard, so it only contains current layers
+        snapshot = InventorySnapshot(aws, True, full_rescan=True)
+        snapshot.merge(inventory_checks)
+        snapshot.save()
+        finish_deploy(aws, journal, layer_configs, failures, dockerfile_dir)
+        sys.exit(0)
 
     layer_definitions = layers.get_layer_definitions()
-    layer_configs = layers.generate_layer_configs(layer_definitions, dockerfile_dir)
+    all_layer_configs = layers.generate_layer_configs(layer_definitions, dockerfile_dir)
+
+    layer_configs = all_layer_configs
+    if args.shard is not None:
+        shard_index, num_shards = args.shard
+        shard_layer_names = shards.partition(
+            list(all_layer_configs.keys()), aws.get_build_costs(),
+            get_layers_to_build(aws, all_layer_configs), num_shards)[shard_index - 1]
+        layer_configs = {name: all_layer_configs[name] for name in shard_layer_names}
+        print(f'Shard {shard_index}/{num_shards} contains {len(layer_configs)} of {len(all_layer_configs)} layers')
+
+    # The snapshot is only saved when deploying, since validation runs can't write to S3. Shards don't
+    # save it, their checks are saved by the merge step instead.
+    snapshot = InventorySnapshot(aws, is_deploy and args.shard is None, full_rescan=args.full_rescan)
 
     existing_layers_by_region = aws.get_existing_layers_by_region()
 
     # This evaluates all of the existing layers against the desired layers to
     # find differences (existing layers that must be changed, new layers that must be created)
-    process_existing_layer_data(aws, is_deploy, layer_configs, existing_layers_by_region)
+    process_existing_layer_data(aws, is_deploy, layer_configs, existing_layers_by_region, snapshot, all_layer_configs.keys())
+    snapshot.save()
     
+    # Regional publications from every build are run by a shared pool of workers. A region that
+    # fails is retried in the background without holding up the builds or the other regions,
+    # and is reported if it fails on every attempt.
+    publish_queue = RetryQueue(
+        Constants.REGION_PUBLISH_WORKERS, aws.deploy_layer_to_region, expand_input=True,
+        max_attempts=Constants.REGION_RETRY_MAX_ATTEMPTS,
+        base_delay=Constants.REGION_RETRY_BASE_DELAY,
+        max_delay=Constants.REGION_RETRY_MAX_DELAY)
+
     # This finds all layer configs where a deployment is missing in one or more regions
     build_configs = {
         k: {
             'layer_config': layer_config,
-            'stream_output': docker_workers == 1,
             'regions_to_publish': [
                 region
                 for region, existing_layer in layer_config['regional'].items()
                 if existing_layer is None
             ],
             'is_deploy': is_deploy,
-            'aws': aws
+            'aws': aws,
+            'journal': journal,
+            'publish_queue': publish_queue,
         }
         for k, layer_config in layer_configs.items()
         if len([True for existing_layer in layer_config['regional'].values() if existing_layer is None]) > 0
@@ -242,12 +549,44 @@ if __name__ == "__main__":
         print('Building and publishing...')
     else:
         print('Building...')
-    concurrent_func(docker_workers, layers.build_layer,
-                    build_configs, expand_input=True)
+    build_results = concurrent_func(docker_workers, layers.build_layer,
+                                    build_configs, expand_input=True)
     
-    print('All builds successful!')
+    failures = [failure for layer_failures in build_results.values() for failure in layer_failures]
+    if len(failures) == 0:
+        print('All builds successful!')
+
+    # If we're only validating, exit here once the layers that were built have been benchmarked
+    previous_benchmarks = get_previous_benchmarks(aws)
+    if not is_deploy:
+        benchmark.benchmark_layers(aws, layer_configs, previous_benchmarks, download=False)
+        if len(failures) > 0:
+            report_failures(failures, dockerfile_dir)
+            sys.exit(1)
+        sys.exit(0)
+
+    # Always wait for the publications of the layers that were built, even if others failed, so
+    # the metadata and failure report include everything that was published
+    print('Waiting for regional publications to complete...')
+    _, publish_failures = publish_queue.wait()
+
+    # Layers that weren't built by this run may still need to be benchmarked (e.g. if their benchmark
+    # config changed), so they're downloaded once they've been published
+    benchmark.benchmark_layers(aws, layer_configs, previous_benchmarks, download=True)
+    failures.extend(
+        {
+            'layer_name': layer_name,
+            'region': region,
+            'attempts': failure['attempts'],
+            'error': failure['error'],
+        }
+        for (layer_name, region), failure in publish_failures.items()
+    )
 
-    # If we're only validating, exit here
-    if is_deploy:
-        upload_metadata(aws, layer_configs)
-        print('All builds and publications complete!')
+    # A shard only writes its results, the metadata is uploaded once all shards are merged
+    if args.shard is not None:
+        os.makedirs(args.shard_output, exist_ok=True)
+        shards.write_shard_output(args.shard_output, shard_index, num_shards, layer_configs, failures, snapshot.checks)
+        sys.exit(0)
+
+    finish_deploy(aws, journal, layer_configs, failures, dockerfile_dir)
@@ -1,5 +1,7 @@
-import concurrent
-from collections.abc import Mapping
+import concurrent.futures
+import random
+import threading
+from collections.abc import Iterable, Mapping
 
 # Runs a function many times concurrently on a set of inputs
 def concurrent_func(num_workers, worker_func, inputs: dict, expand_input=False):
@@ -32,3 +34,97 @@ def concurrent_func(num_workers, worker_func, inputs: dict, expand_input=False):
     if err is not None:
         raise err
     return results
+
+
+# Runs a function concurrently on each input from an iterable, with at most max_pending inputs
+# submitted but not yet complete. Inputs are only consumed from the iterable as fast as they're
+# processed, so they can be generated lazily without holding every input in memory. Results aren't kept, and the
+# number of inputs that were processed is returned. If any input fails, no more are submitted
+# and the first error is raised once the submitted inputs are complete.
+def bounded_concurrent_func(num_workers, worker_func, inputs: Iterable, max_pending, expand_input=False):
+    slots = threading.Semaphore(max_pending)
+    errors = []
+    num_processed = 0
+
+    def on_done(future):
+        if future.exception() is not None:
+            errors.append(future.exception())
+        slots.release()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+        for inpt in inputs:
+            slots.acquire()
+            if len(errors) > 0:
+                break
+            _submit(executor, worker_func, inpt, expand_input).add_done_callback(on_done)
+            num_processed += 1
+    if len(errors) > 0:
+        raise errors[0]
+    return num_processed
+
+
+# Submits a single input to an executor
+def _submit(executor, worker_func, inpt, expand_input):
+    if expand_input:
+        if isinstance(inpt, Mapping):
+            return executor.submit(worker_func, **inpt)
+        return executor.submit(worker_func, *inpt)
+    return executor.submit(worker_func, inpt)
+
+
+# A queue of inputs that are processed concurrently by a shared pool of workers, and can be
+# added to from any thread. A failure doesn't affect any of the other inputs: a failed input is
+# resubmitted after an exponential backoff (with jitter), without holding a worker while it
+# waits, and is reported if it fails on every attempt. Once everything has been submitted, wait()
+# returns the results of the inputs that succeeded, and a dict of the inputs that failed on every
+# attempt, with the number of attempts and the final error.
+class RetryQueue:
+    def __init__(self, num_workers, worker_func, expand_input=False, max_attempts=5, base_delay=5, max_delay=120):
+        self.worker_func = worker_func
+        self.expand_input = expand_input
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=num_workers)
+        self.condition = threading.Condition()
+        self.num_pending = 0
+        self.results = {}
+        self.failures = {}
+
+    # Adds an input to the queue, identified by a key that's unique among all inputs
+    def submit(self, key, inpt):
+        with self.condition:
+            self.num_pending += 1
+        self._submit_attempt(key, inpt, 1)
+
+    def _submit_attempt(self, key, inpt, attempt):
+        future = _submit(self.executor, self.worker_func, inpt, self.expand_input)
+        future.add_done_callback(lambda future: self._on_done(key, inpt, attempt, future))
+
+    def _on_done(self, key, inpt, attempt, future):
+        e = future.exception()
+        if e is not None and attempt < self.max_attempts:
+            delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1)) * random.uniform(0.5, 1)
+            print(f'Attempt {attempt} of {self.max_attempts} for {key} failed ({type(e).__name__}: {e}), retrying in {delay:.0f} seconds')
+            # The backoff is waited out by a timer, so the worker is free for other inputs
+            timer = threading.Timer(delay, self._submit_attempt, args=(key, inpt, attempt + 1))
+            timer.daemon = True
+            timer.start()
+            return
+        with self.condition:
+            if e is None:
+                self.results[key] = future.result()
+            else:
+                self.failures[key] = {
+                    'attempts': attempt,
+                    'error': f'{type(e).__name__}: {e}',
+                }
+            self.num_pending -= 1
+            self.condition.notify_all()
+
+    # Waits for every input to succeed or fail on every attempt, then shuts down the workers
+    def wait(self):
+        with self.condition:
+            self.condition.wait_for(lambda: self.num_pending == 0)
+        self.executor.shutdown(wait=True)
+        return self.results, self.failures
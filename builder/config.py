@@ -8,17 +8,112 @@ class Constants:
         'arm64': 'linux/arm64',
     }
 
+    # The directory that Lambda extracts layer contents to
+    LAYER_MOUNT_DIRECTORY = '/opt'
+
+    # The default glob patterns for the names of directories that are pruned from a layer
+    # when its "optimize" configuration doesn't specify a deny list
+    DEFAULT_PRUNE_DENY = [
+        'tests',
+        'test',
+        'docs',
+        'doc',
+    ]
+
+    # Glob patterns for paths, relative to the root of the layer, that are never pruned even if
+    # their names are denied, because they're imported at runtime. These are kept in addition to
+    # any that a layer's "optimize" configuration allows.
+    DEFAULT_PRUNE_ALLOW = [
+        # Imported by "botocore.client" and "boto3.resources.factory"
+        '*/botocore/docs',
+        '*/boto3/docs',
+    ]
+
+    # The image used to benchmark the imports of a built layer, formatted with the Python version
+    BENCHMARK_IMAGE = 'public.ecr.aws/lambda/python:{version}'
+
+    # The number of times the imports are measured when benchmarking a layer, if not specified
+    BENCHMARK_DEFAULT_ITERATIONS = 5
+
+    # The number of most recent output lines of a build that are kept in memory, for
+    # reporting if the build fails (the full output is written to the build's log file)
+    BUILD_LOG_TAIL_LINES = 200
+
+    # The number of attempts to publish a layer to a region before it's reported as a failure
+    REGION_RETRY_MAX_ATTEMPTS = 5
+
+    # The delay (in seconds) before the first retry of a failed regional publication, which
+    # doubles with each subsequent attempt up to the maximum
+    REGION_RETRY_BASE_DELAY = 5
+    REGION_RETRY_MAX_DELAY = 120
+
+    # The number of regional publications (across all layers) that are run concurrently
+    REGION_PUBLISH_WORKERS = 64
+
+    # The number of attempts that the AWS SDK makes for each call when publishing to a region.
+    # Failed publications are retried with a backoff by the publish queue, so this is kept low
+    # to stop a failing region from tying up a worker with the SDK's own retries.
+    REGION_PUBLISH_CLIENT_MAX_ATTEMPTS = 3
+
     # The prefix of the S3 bucket name for deployment artifacts
     ARTIFACT_BUCKET_PREFIX = 'invicton-labs-public-lambda-layers-'
 
+    # The prefix of the checkpoint journal objects in the primary region's artifact bucket
+    CHECKPOINT_PREFIX = 'checkpoints/'
+
+    # The object in the primary region's artifact bucket that tracks how long each layer took
+    # to build, which is used to balance layers between shards
+    BUILD_COSTS_OBJECT = 'build-costs.json'
+
+    # The inventory snapshot object name in the primary region's artifact bucket
+    INVENTORY_SNAPSHOT_OBJECT = 'inventory-snapshot.json'
+
+    # The maximum age (in seconds) of a layer's check in the inventory snapshot before the layer is
+    # checked again, even if its version hasn't changed, to catch drift such as edited layer policies
+    INVENTORY_CHECK_MAX_AGE = 7 * 24 * 60 * 60
+
     # The S3 bucket where metadata is kept
     METADATA_BUCKET = "invicton-labs-public-lambda-layers"
 
+    # The ID of the CloudFront distribution that serves the metadata
+    CLOUDFRONT_DISTRIBUTION_ID = 'E1GH306YC7UXCZ'
+
     # The metadata JSON file object name
     METADATA_OBJECT = 'layers.json'
 
-    # The ID of the CloudFront distribution that serves the metadata
-    CLOUDFRONT_DISTRIBUTION_ID = 'E1GH306YC7UXCZ'
+    # The SQLite index object name
+    METADATA_INDEX_OBJECT = 'layers.sqlite'
+
+    # The gzip-compressed copy of the SQLite index, since CloudFront doesn't compress SQLite files
+    METADATA_COMPRESSED_INDEX_OBJECT = 'layers.sqlite.gz'
+
+    # The metadata manifest object name, which maps the top-level metadata documents, and the manifest
+    # of each package, to their immutable keys
+    METADATA_MANIFEST_OBJECT = 'manifest.json'
+
+    # The path of each package's manifest, which maps each of the package's metadata documents to its immutable key
+    METADATA_PACKAGE_MANIFEST_PATH = 'manifests/{package}.json'
+
+    # The prefix of the immutable metadata objects, which are named by the SHA256 hash of their content
+    # (with the same extension as the document)
+    METADATA_OBJECTS_PREFIX = 'objects/'
+
+    # How long (in seconds) an immutable metadata object is kept after it was uploaded, once it's no
+    # longer referenced by the current or previous manifest, so that clients that are still using an
+    # older manifest can finish reading the documents it references
+    METADATA_OBJECTS_RETENTION = 24 * 60 * 60
+
+    # The Cache-Control header for immutable metadata objects
+    METADATA_IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+    # The Cache-Control header for metadata documents at mutable paths, including the manifest
+    METADATA_MUTABLE_CACHE_CONTROL = 'public, max-age=60, must-revalidate'
+
+    # The number of concurrent uploads of metadata documents
+    METADATA_UPLOAD_WORKERS = 100
+
+    # The maximum number of metadata documents that are generated but not yet uploaded
+    METADATA_UPLOAD_MAX_PENDING = 200
 
     # The ID of the Lambda signing platform in AWS Signer
     LAMBDA_SIGNING_PLATFORM_ID = "AWSLambda-SHA384-ECDSA"
@@ -0,0 +1,192 @@
+import json
+import re
+import sqlite3
+
+# The schema of the SQLite index. To keep it compact, there's one row for each build of a package
+# (version, runtime and architecture) and one for each region it's published in, and text that's
+# repeated between rows (e.g. descriptions and hashes) is stored once in the strings table. The
+# layers view joins them back together, with one row per package, version, runtime, architecture
+# and region.
+SCHEMA = '''
+CREATE TABLE strings (
+    id INTEGER PRIMARY KEY,
+    value TEXT NOT NULL
+);
+
+CREATE TABLE layer_builds (
+    id INTEGER PRIMARY KEY,
+    package TEXT NOT NULL,
+    package_version TEXT NOT NULL,
+    -- The order of the version among all versions of the package (higher is newer)
+    package_version_rank INTEGER NOT NULL,
+    runtime TEXT NOT NULL,
+    architecture TEXT NOT NULL,
+    layer_name TEXT NOT NULL
+);
+
+CREATE INDEX layer_builds_by_package ON layer_builds (package, runtime, architecture, package_version_rank);
+
+CREATE TABLE layer_regions (
+    build_id INTEGER NOT NULL REFERENCES layer_builds (id),
+    region TEXT NOT NULL,
+    -- The layer ARN without the layer name (e.g. "arn:aws:lambda:us-east-1:123456789012:layer:")
+    layer_arn_prefix_id INTEGER NOT NULL REFERENCES strings (id),
+    layer_version INTEGER NOT NULL,
+    description_id INTEGER REFERENCES strings (id),
+    license_info_id INTEGER REFERENCES strings (id),
+    created_date TEXT,
+    signing_job_arn_id INTEGER REFERENCES strings (id),
+    signing_profile_version_arn_id INTEGER REFERENCES strings (id),
+    source_code_hash_id INTEGER REFERENCES strings (id),
+    source_code_size INTEGER,
+    -- The benchmark results as a JSON object, if the layer has been benchmarked
+    benchmark_id INTEGER REFERENCES strings (id),
+    PRIMARY KEY (build_id, region)
+) WITHOUT ROWID;
+
+CREATE VIEW layers AS
+SELECT
+    b.package,
+    b.package_version,
+    b.package_version_rank,
+    b.runtime,
+    b.architecture,
+    r.region,
+    b.layer_name,
+    arn_prefix.value || b.layer_name AS layer_arn,
+    arn_prefix.value || b.layer_name || ':' || r.layer_version AS layer_version_arn,
+    r.layer_version,
+    description.value AS description,
+    license_info.value AS license_info,
+    r.created_date,
+    signing_job_arn.value AS signing_job_arn,
+    signing_profile_version_arn.value AS signing_profile_version_arn,
+    source_code_hash.value AS source_code_hash,
+    r.source_code_size,
+    benchmark.value AS benchmark
+FROM layer_regions r
+JOIN layer_builds b ON b.id = r.build_id
+JOIN strings arn_prefix ON arn_prefix.id = r.layer_arn_prefix_id
+LEFT JOIN strings description ON description.id = r.description_id
+LEFT JOIN strings license_info ON license_info.id = r.license_info_id
+LEFT JOIN strings signing_job_arn ON signing_job_arn.id = r.signing_job_arn_id
+LEFT JOIN strings signing_profile_version_arn ON signing_profile_version_arn.id = r.signing_profile_version_arn_id
+LEFT JOIN strings source_code_hash ON source_code_hash.id = r.source_code_hash_id
+LEFT JOIN strings benchmark ON benchmark.id = r.benchmark_id;
+
+-- The newest version of each package for each runtime, architecture and region
+CREATE VIEW latest_layers AS
+SELECT l.* FROM layers l
+WHERE l.package_version_rank = (
+    SELECT MAX(b.package_version_rank) FROM layer_builds b
+    JOIN layer_regions r ON r.build_id = b.id
+    WHERE b.package = l.package AND b.runtime = l.runtime AND b.architecture = l.architecture AND r.region = l.region
+);
+
+-- The newest version of each package
+CREATE VIEW latest_package_versions AS
+SELECT package, package_version FROM layer_builds b
+WHERE b.package_version_rank = (
+    SELECT MAX(package_version_rank) FROM layer_builds WHERE package = b.package
+)
+GROUP BY package, package_version;
+'''
+
+
+# The order of the labels that can follow the release number of a package version, relative to
+# the release itself. Any other label (e.g. "post") is treated as newer than the release.
+VERSION_LABEL_RANKS = {
+    'dev': 0,
+    'a': 1,
+    'alpha': 1,
+    'b': 2,
+    'beta': 2,
+    'c': 3,
+    'rc': 3,
+    'pre': 3,
+    'preview': 3,
+}
+VERSION_RELEASE_RANK = 4
+VERSION_OTHER_LABEL_RANK = 5
+VERSION_NUMBER_RANK = 6
+
+
+# A sort key for package versions, which compares the numeric parts of the release number
+# numerically (so "2.10.0" is newer than "2.9.1", and "2.0" is the same as "2.0.0"), and then
+# any labels, so pre-releases are older than the release ("2.0.0rc1" < "2.0.0") and
+# post-releases are newer ("2.0.0" < "2.0.0.post1").
+def version_sort_key(version):
+    parts = re.findall(r'\d+|[a-z]+', version.lower())
+    release = []
+    while len(parts) > 0 and parts[0].isdigit():
+        release.append(int(parts.pop(0)))
+    while len(release) > 0 and release[-1] == 0:
+        release.pop()
+    if len(parts) == 0:
+        return release, [(VERSION_RELEASE_RANK, '', 0)]
+    return release, [
+        (VERSION_NUMBER_RANK, '', int(part)) if part.isdigit()
+        else (VERSION_LABEL_RANKS.get(part, VERSION_OTHER_LABEL_RANK), part, 0)
+        for part in parts
+    ]
+
+
+# Generates the SQLite index of all layers from the nested layer metadata, and returns the
+# database file content. Rows are inserted in a consistent order so that the same metadata
+# always produces the same file.
+def generate_index(metadata):
+    connection = sqlite3.connect(':memory:')
+    try:
+        connection.executescript(SCHEMA)
+        string_ids = {}
+
+        # Returns the ID of a string in the strings table, adding it the first time it's seen
+        def string_id(value):
+            if value is None:
+                return None
+            if value not in string_ids:
+                string_ids[value] = len(string_ids) + 1
+                connection.execute('INSERT INTO strings (id, value) VALUES (?, ?)', [string_ids[value], value])
+            return string_ids[value]
+
+        build_id = 0
+        for package_name in sorted(metadata.keys()):
+            package_config = metadata[package_name]
+            # Versions that are equivalent (e.g. "2.0" and "2.0.0") are ordered by name, so the order is consistent
+            versions = sorted(package_config.keys(), key=lambda version: (version_sort_key(version), version))
+            for rank, version in enumerate(versions):
+                for runtime, runtime_config in sorted(package_config[version].items()):
+                    for architecture, architecture_config in sorted(runtime_config.items()):
+                        if len(architecture_config) == 0:
+                            continue
+                        build_id += 1
+                        layer_name = next(iter(architecture_config.values()))['layer_name']
+                        connection.execute(
+                            'INSERT INTO layer_builds (id, package, package_version, package_version_rank, runtime, architecture, layer_name) '
+                            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                            [build_id, package_name, version, rank, runtime, architecture, layer_name])
+                        for region, region_config in sorted(architecture_config.items()):
+                            benchmark = region_config.get('benchmark')
+                            connection.execute(
+                                'INSERT INTO layer_regions (build_id, region, layer_arn_prefix_id, layer_version, description_id, '
+                                'license_info_id, created_date, signing_job_arn_id, signing_profile_version_arn_id, '
+                                'source_code_hash_id, source_code_size, benchmark_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                [
+                                    build_id,
+                                    region,
+                                    string_id(region_config['layer_arn'].removesuffix(layer_name)),
+                                    region_config['layer_version'],
+                                    string_id(region_config['description']),
+                                    string_id(region_config['license_info']),
+                                    region_config['created_date'],
+                                    string_id(region_config['signing_job_arn']),
+                                    string_id(region_config['signing_profile_version_arn']),
+                                    string_id(region_config['source_code_hash']),
+                                    region_config['source_code_size'],
+                                    string_id(None if benchmark is None else json.dumps(benchmark, separators=(',', ':'), sort_keys=True)),
+                                ])
+        connection.commit()
+        connection.execute('VACUUM')
+        return connection.serialize()
+    finally:
+        connection.close()
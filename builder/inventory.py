@@ -0,0 +1,50 @@
+import time
+from config import Constants
+
+
+# A persistent snapshot of the checks of existing layers (their policy and content) from previous
+# runs, keyed by region and layer name. If a layer's version hasn't changed since it was checked,
+# and it was checked recently enough, the check is reused instead of calling the Lambda API.
+#
+# There's a single snapshot that every run (and every shard) reads. Only the checks made or reused
+# by the current run are kept, so the snapshot never contains layers that are no longer tracked.
+# Shards don't save it themselves: their checks are passed to the merge step, which saves them all.
+# A snapshot that isn't enabled (e.g. when only validating) is still loaded, but never saved.
+class InventorySnapshot:
+    def __init__(self, aws, enabled, full_rescan=False):
+        self.aws = aws
+        self.enabled = enabled
+        self.previous_checks = {}
+        self.checks = {}
+        if not full_rescan:
+            snapshot = aws.get_inventory_snapshot()
+            if snapshot is not None:
+                self.previous_checks = snapshot['checks']
+
+    # Returns the check for a version of a layer in a region from the snapshot, or None if it
+    # wasn't checked, a different version was checked, or the check is too old
+    def get_check(self, region, layer_name, version):
+        check = self.previous_checks.get(region, {}).get(layer_name)
+        if check is None or check['version'] != version:
+            return None
+        if time.time() - check['checked_at'] > Constants.INVENTORY_CHECK_MAX_AGE:
+            return None
+        return check
+
+    # Records the check for a layer in a region. A check that was reused keeps the time it was made.
+    def update(self, region, layer_name, check):
+        self.checks.setdefault(region, {})[layer_name] = {
+            'checked_at': time.time(),
+        } | check
+
+    # Adds checks that were recorded by another snapshot (e.g. from a shard)
+    def merge(self, checks):
+        for region, layer_checks in checks.items():
+            self.checks.setdefault(region, {}).update(layer_checks)
+
+    def save(self):
+        if not self.enabled:
+            return
+        self.aws.put_inventory_snapshot({
+            'checks': self.checks,
+        })
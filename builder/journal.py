@@ -0,0 +1,59 @@
+import collections
+import threading
+
+
+# A persistent checkpoint journal that records the progress of each layer's deployment
+# (the uploaded build artifact and the signing job) in S3, so that a run that fails part-way
+# through can resume where the previous one stopped instead of rebuilding and re-signing
+# everything. Regional publications aren't recorded, since the next run finds them in each
+# region's inventory and only publishes to the regions that are still missing the layer.
+#
+# Each layer has its own record, which is only used if it was created for the same
+# Dockerfile hash as the current layer config. A journal that isn't enabled (e.g. when
+# only validating) never loads or stores anything.
+class Journal:
+    def __init__(self, aws, enabled, fresh=False):
+        self.aws = aws
+        self.enabled = enabled
+        self.fresh = fresh
+        self.records = {}
+        self.lock = threading.Lock()
+        self.layer_locks = collections.defaultdict(threading.Lock)
+
+    def _layer_lock(self, layer_name):
+        with self.lock:
+            return self.layer_locks[layer_name]
+
+    # Returns the checkpoint record for a layer, loading it from S3 the first time
+    def get(self, layer_config):
+        if not self.enabled:
+            return {}
+        with self._layer_lock(layer_config['name']):
+            if layer_config['name'] not in self.records:
+                record = None
+                if not self.fresh:
+                    record = self.aws.get_checkpoint(layer_config['name'])
+                # Ignore records for a previous version of the layer
+                if record is None or record.get('df_sha256') != layer_config['dockerfile_sha256']:
+                    record = {
+                        'df_sha256': layer_config['dockerfile_sha256'],
+                    }
+                self.records[layer_config['name']] = record
+            return self.records[layer_config['name']]
+
+    # Records that a stage of a layer's deployment has completed, and persists it
+    def record(self, layer_config, stage, data):
+        if not self.enabled:
+            return
+        record = self.get(layer_config)
+        with self._layer_lock(layer_config['name']):
+            record[stage] = data
+            self.aws.put_checkpoint(layer_config['name'], record)
+
+    # Removes all checkpoint records once a run has completed successfully
+    def clear(self):
+        if not self.enabled:
+            return
+        self.aws.delete_checkpoints()
+        with self.lock:
+            self.records = {}
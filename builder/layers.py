@@ -1,13 +1,16 @@
+import os
 import json
 import glob
 import pathlib
 import re
 import hashlib
 import base64
-import subprocess
+import shlex
+import time
 import jsonschema
 import jsonref
 from config import Constants
+from logs import BuildLog
 
 # Parses the filesystem to load the layer files with their names
 def get_layer_definitions():
@@ -53,9 +56,67 @@ def get_layer_definitions():
     return layer_definitions
 
 
+# Generates the Dockerfile instructions for the optional post-install optimization stages.
+# Returns the instructions and the name of the stage that the optimized "/layer" directory
+# should be copied from.
+def generate_optimize_instructions(optimize_config, image, layer_source_directory, layer_target_directory, optimize_path):
+    prune_config = optimize_config.get('prune')
+    compile_bytecode = optimize_config.get('compile_bytecode', False)
+    strip_shared_objects = optimize_config.get('strip_shared_objects', False)
+
+    lines = [
+        'FROM alpine:latest AS optimize_image',
+    ]
+    if strip_shared_objects:
+        lines.append('RUN apk add --no-cache binutils')
+    lines.extend([
+        f'COPY --from=build_image "{layer_source_directory}" "/layer/{layer_target_directory.lstrip('/')}"',
+        'WORKDIR /layer',
+        # Record the size before optimization so it can be reported once the layer is built
+        f'RUN mkdir {optimize_path} && du -sk /layer | cut -f1 > {optimize_path}/size_before',
+    ])
+
+    if compile_bytecode:
+        # Bytecode compiled by pip may be for a different interpreter (or missing entirely),
+        # so remove all of it and compile it fresh in the build image below
+        lines.append('RUN find . -depth -type d -name __pycache__ -exec rm -rf {} +')
+
+    if prune_config is not None:
+        deny_patterns = prune_config.get('deny', Constants.DEFAULT_PRUNE_DENY)
+        allow_patterns = Constants.DEFAULT_PRUNE_ALLOW + prune_config.get('allow', [])
+        if len(deny_patterns) > 0:
+            deny_expression = ' -o '.join(
+                f'-name {shlex.quote(pattern)}' for pattern in deny_patterns)
+            allow_expressions = ''.join(
+                f' ! -path {shlex.quote(f'./{pattern}')} ! -path {shlex.quote(f'./{pattern}/*')}' for pattern in allow_patterns)
+            lines.append(
+                f'RUN find . -depth -type d \\( {deny_expression} \\){allow_expressions} -exec rm -rf {{}} +')
+
+    if strip_shared_objects:
+        lines.append(
+            'RUN find . -type f \\( -name "*.so" -o -name "*.so.*" \\) -exec strip --strip-debug {} +')
+
+    if not compile_bytecode:
+        return lines, 'optimize_image'
+
+    # Compile in the build image so the bytecode matches the target runtime exactly. The
+    # hash-based invalidation mode means the runtime never has to stat or read the source
+    # files to validate the cache, and the paths are rewritten to where Lambda extracts the layer.
+    lines.extend([
+        f'FROM {image} AS compile_image',
+        'COPY --from=optimize_image "/layer" "/layer"',
+        # Like pip, files that can't be compiled (e.g. Python 2 test fixtures) are reported but
+        # don't fail the build, they're just left without bytecode
+        f'RUN python3 -m compileall -q -f -j 0 --invalidation-mode unchecked-hash -s /layer -p {Constants.LAYER_MOUNT_DIRECTORY} /layer '
+        '|| echo "Some files could not be compiled to bytecode, they will be left uncompiled"',
+    ])
+    return lines, 'compile_image'
+
+
 # Parses the layer JSON files and generates Dockerfiles for each
 def generate_layer_configs(layer_definitions, directory):
     package_path = '/package.zip'
+    optimize_path = '/optimize'
     layer_configs = {}
     package_pattern = '^[a-z0-9-]+$'
     runtime_pattern = '^[a-z0-9.]+$'
@@ -118,11 +179,28 @@ def generate_layer_configs(layer_definitions, directory):
                     dockerfile_lines.extend(package_config.get(
                         'common_instructions_post', []))
 
+                    optimize_config = package_config.get('optimize')
+                    if optimize_config is None:
+                        dockerfile_lines.extend([
+                            'FROM alpine:latest',
+                            'RUN apk add --no-cache zip',
+                            f'COPY --from=build_image "{layer_source_directory}" "/layer/{layer_target_directory.lstrip('/')}"',
+                            'WORKDIR /layer',
+                        ])
+                    else:
+                        optimize_lines, optimized_stage = generate_optimize_instructions(
+                            optimize_config, image, layer_source_directory, layer_target_directory, optimize_path)
+                        dockerfile_lines.extend(optimize_lines)
+                        dockerfile_lines.extend([
+                            'FROM alpine:latest',
+                            'RUN apk add --no-cache zip',
+                            f'COPY --from=optimize_image "{optimize_path}" "{optimize_path}"',
+                            f'COPY --from={optimized_stage} "/layer" "/layer"',
+                            'WORKDIR /layer',
+                            f'RUN du -sk /layer | cut -f1 > {optimize_path}/size_after',
+                        ])
+
                     dockerfile_lines.extend([
-                        'FROM alpine:latest',
-                        'RUN apk add --no-cache zip',
-                        f'COPY --from=build_image "{layer_source_directory}" "/layer/{layer_target_directory.lstrip('/')}"',
-                        'WORKDIR /layer',
                         # This command will ignore extra attributes such as file times
                         # This is so that the output file has the same hash as long as the contents
                         # of the contained files remain the same
@@ -147,6 +225,18 @@ def generate_layer_configs(layer_definitions, directory):
                         'version': version,
                         'architecture': architecture,
                         'archive_path': f"{directory}/{layer_name}.zip",
+                        'layer_target_directory': layer_target_directory,
+                        'benchmark': package_config.get('benchmark'),
+                        'benchmark_path': f"{directory}/{layer_name}.benchmark",
+                        'benchmark_log_path': f"{directory}/{layer_name}.benchmark.log",
+                        'benchmark_results': None,
+                        'optimize': optimize_config,
+                        'optimize_path': optimize_path,
+                        'optimize_report_path': f"{directory}/{layer_name}.optimize",
+                        'optimize_report': None,
+                        'archive_sha256': None,
+                        'build_duration': None,
+                        'log_path': f"{directory}/{layer_name}.log",
                         'image_tag': f"{layer_name}:local",
                         'platform': Constants.ARCHITECTURE_LOOKUP[architecture],
                         'name': layer_name,
@@ -162,83 +252,104 @@ def generate_layer_configs(layer_definitions, directory):
     return layer_configs
 
 
-# This builds the Docker image, extracts the built layer from it, pushes it to S3, signs it, then publishes it to each region
-def build_layer(layer_config, stream_output, regions_to_publish, is_deploy, aws):
+# This builds the Docker image, extracts the built layer from it, pushes it to S3, signs it, then publishes it to each region.
+# The regional publications are handed off to the shared publish queue. Returns a list of the regions that the
+# layer couldn't be published to because it couldn't be built, uploaded or signed. A failure only affects this
+# layer, so the other layers carry on building and publishing.
+def build_layer(layer_config, regions_to_publish, is_deploy, aws, journal, publish_queue):
+    try:
+        return _build_layer(layer_config, regions_to_publish, is_deploy, aws, journal, publish_queue)
+    except Exception as e:
+        print(f'Failed to build and deploy layer {layer_config['name']}: {type(e).__name__}: {e}')
+        return [
+            {
+                'layer_name': layer_config['name'],
+                'region': region,
+                'attempts': 1,
+                'error': f'{type(e).__name__}: {e}',
+            }
+            for region in regions_to_publish
+        ]
+
+
+def _build_layer(layer_config, regions_to_publish, is_deploy, aws, journal, publish_queue):
+    # If a previous run already built and uploaded this layer, skip straight to deploying it
+    checkpoint = journal.get(layer_config)
+    if 'build' in checkpoint:
+        print(f'Skipping build of layer {layer_config['name']}, it was built by a previous run')
+        layer_config['archive_sha256'] = checkpoint['build']['archive_sha256']
+        layer_config['optimize_report'] = checkpoint['build']['optimize_report']
+        return aws.deploy_layer(layer_config, regions_to_publish, journal, publish_queue)
+
     with open(layer_config['dockerfile_path'], "w", newline='\n') as f:
         # Writing data to a file
         f.write(layer_config['dockerfile_content'])
 
-    stderr = None
-    stdout = None
-    if not stream_output:
-        stderr = subprocess.STDOUT
-        stdout = subprocess.PIPE
-
-    # Build the image and load it into the local registry
-    print(f'Building layer {layer_config['name']}...')
-    try:
-        subprocess.run(['docker', 'buildx', 'build', '--progress', 'plain', '--platform',
-                        layer_config['platform'], '--load', '-t', layer_config['image_tag'],
-                        '-f', layer_config['dockerfile_path'], '.'], check=True, stderr=stderr, 
-                        stdout=stdout
-                    )
-    except subprocess.CalledProcessError as e:
-        if e.stdout is not None:
-            print(e.stdout.decode())
-        raise e
-
-    # Remove any existing containers of the same name
-    try:
-        subprocess.run(
-            ['docker', 'rm', '-f', layer_config['name']], check=True, stderr=subprocess.STDOUT,
-            stdout=subprocess.PIPE)
-    except subprocess.CalledProcessError as e:
-        if e.stdout is not None:
-            print(e.stdout.decode())
-        raise e
-
-    # Create a new container with this image
-    try:
-        subprocess.run(['docker', 'create', '-ti', '--name', layer_config['name'],
-                            '--platform', layer_config['platform'], layer_config['image_tag']], 
-                            check=True, stderr=subprocess.STDOUT, stdout=subprocess.PIPE)
-    except subprocess.CalledProcessError as e:
-        if e.stdout is not None:
-            print(e.stdout.decode())
-        raise e
-
-    # Copy the layer files from it
-    try:
-        subprocess.run(['docker', 'cp', f'{layer_config['name']}:{layer_config['package_path']}', 
-                        layer_config['archive_path']], check=True, 
-                        stderr=subprocess.STDOUT, stdout=subprocess.PIPE)
-    except subprocess.CalledProcessError as e:
-        if e.stdout is not None:
-            print(e.stdout.decode())
-        raise e
-
-    # Remove the container we just created
-    try:
-        subprocess.run(
-            ['docker', 'rm', '-f', layer_config['name']], check=True, 
-            stderr=subprocess.STDOUT, stdout=subprocess.PIPE)
-    except subprocess.CalledProcessError as e:
-        if e.stdout is not None:
-            print(e.stdout.decode())
-        raise e
-
-    # Remove the image we just created
-    try:
-        subprocess.run(
-            ['docker', 'image', 'rm', layer_config['image_tag']], check=True, 
-            stderr=subprocess.STDOUT, stdout=subprocess.PIPE)
-    except subprocess.CalledProcessError as e:
-        if e.stdout is not None:
-            print(e.stdout.decode())
-        raise e
+    # All command output is written to the layer's log file, and streamed live (prefixed with
+    # the layer name). Only the tail is kept in memory for reporting failures.
+    build_start = time.monotonic()
+    with BuildLog(layer_config['name'], layer_config['log_path']) as log:
+        # Build the image and load it into the local registry
+        print(f'Building layer {layer_config['name']}...')
+        log.run(['docker', 'buildx', 'build', '--progress', 'plain', '--platform',
+                 layer_config['platform'], '--load', '-t', layer_config['image_tag'],
+                 '-f', layer_config['dockerfile_path'], '.'])
+
+        # Remove any existing containers of the same name
+        log.run(['docker', 'rm', '-f', layer_config['name']])
+
+        # Create a new container with this image
+        log.run(['docker', 'create', '-ti', '--name', layer_config['name'],
+                 '--platform', layer_config['platform'], layer_config['image_tag']])
+
+        # Copy the layer files from it
+        log.run(['docker', 'cp', f'{layer_config['name']}:{layer_config['package_path']}',
+                 layer_config['archive_path']])
+
+        # Copy the optimization sizes from it and report the reduction
+        if layer_config['optimize'] is not None:
+            log.run(['docker', 'cp', f'{layer_config['name']}:{layer_config['optimize_path']}',
+                     layer_config['optimize_report_path']])
+            report_optimization(layer_config)
+
+        # Remove the container we just created
+        log.run(['docker', 'rm', '-f', layer_config['name']])
+
+        # Remove the image we just created
+        log.run(['docker', 'image', 'rm', layer_config['image_tag']])
+
+        # Track how long the build took, for balancing layers between shards in future runs
+        layer_config['build_duration'] = time.monotonic() - build_start
+
+    # Calculate the hash of the built archive so it can be tracked in the checkpoint journal
+    h = hashlib.sha256()
+    with open(layer_config['archive_path'], mode='rb') as f:
+        for chunk in iter(lambda: f.read(1048576), b''):
+            h.update(chunk)
+    layer_config['archive_sha256'] = h.hexdigest()
 
     if not is_deploy:
-        return
+        return []
     
-    # Now deploy it!
-    aws.deploy_layer(layer_config, regions_to_publish)
+    # Now deploy it! This returns any regions that the layer couldn't be published to.
+    return aws.deploy_layer(layer_config, regions_to_publish, journal, publish_queue)
+
+
+# Reads the sizes recorded by the optimization stage of a build and reports the reduction
+def report_optimization(layer_config):
+    sizes = {}
+    for name in ['size_before', 'size_after']:
+        with open(f'{layer_config['optimize_report_path']}/{name}', mode='r') as file:
+            # The sizes are recorded by "du -k", so they're in KiB
+            sizes[name] = int(file.read().strip()) * 1024
+
+    layer_config['optimize_report'] = {
+        'size_before': sizes['size_before'],
+        'size_after': sizes['size_after'],
+        'archive_size': os.path.getsize(layer_config['archive_path']),
+    }
+    reduction = sizes['size_before'] - sizes['size_after']
+    percentage = 0 if sizes['size_before'] == 0 else 100 * reduction / sizes['size_before']
+    print(f'Optimized layer {layer_config['name']}: {sizes['size_before'] / 1048576:.1f} MiB -> '
+          f'{sizes['size_after'] / 1048576:.1f} MiB unzipped ({percentage:.1f}% reduction), '
+          f'{layer_config['optimize_report']['archive_size'] / 1048576:.1f} MiB zipped')
@@ -0,0 +1,57 @@
+import collections
+import subprocess
+import sys
+import threading
+from config import Constants
+
+# Shared by all builds so that lines from concurrent builds are never interleaved mid-line
+output_lock = threading.Lock()
+
+
+# Runs the commands for a single build, streaming their output live with a prefix of the
+# build's name (so concurrent builds can be told apart), writing it to a log file, and keeping only the most recent lines in memory
+# so they can be reported if a command fails.
+class BuildLog:
+    def __init__(self, name, log_path):
+        self.name = name
+        self.log_path = log_path
+        self.tail = collections.deque(maxlen=Constants.BUILD_LOG_TAIL_LINES)
+        self.file = None
+
+    def __enter__(self):
+        self.file = open(self.log_path, mode='w', encoding='utf-8')
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.file.close()
+        self.file = None
+
+    def write(self, line):
+        line = line.rstrip('\r\n')
+        self.file.write(f'{line}\n')
+        self.tail.append(line)
+        with output_lock:
+            sys.stdout.write(f'[{self.name}] {line}\n')
+            sys.stdout.flush()
+
+    # Runs a command, raising a CalledProcessError if it fails. If on_line is given, it's
+    # also called with each line of output, for callers that need to parse it.
+    def run(self, args, on_line=None):
+        self.write(f'$ {subprocess.list2cmdline(args)}')
+        process = subprocess.Popen(
+            args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        for line in process.stdout:
+            line = line.decode(errors='replace')
+            self.write(line)
+            if on_line is not None:
+                on_line(line.rstrip('\r\n'))
+        process.stdout.close()
+        returncode = process.wait()
+        self.file.flush()
+        if returncode != 0:
+            with output_lock:
+                print(f'[{self.name}] Command failed with exit code {returncode}. Last {len(self.tail)} lines of output (full log in {self.log_path}):')
+                for line in self.tail:
+                    print(f'[{self.name}] {line}')
+                sys.stdout.flush()
+            raise subprocess.CalledProcessError(returncode, args)
@@ -0,0 +1,208 @@
+import argparse
+import json
+import statistics
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+from concurrency import concurrent_func
+from config import Constants
+import build
+import layers
+
+# Regions used for the synthetic inventory, roughly the number of regions that layers are published to
+REGIONS = [
+    'af-south-1', 'ap-east-1', 'ap-northeast-1', 'ap-northeast-2', 'ap-northeast-3', 'ap-south-1',
+    'ap-south-2', 'ap-southeast-1', 'ap-southeast-2', 'ap-southeast-3', 'ap-southeast-4', 'ca-central-1',
+    'ca-west-1', 'eu-central-1', 'eu-central-2', 'eu-north-1', 'eu-south-1', 'eu-south-2', 'eu-west-1',
+    'eu-west-2', 'eu-west-3', 'il-central-1', 'me-central-1', 'me-south-1', 'sa-east-1', 'us-east-1',
+    'us-east-2', 'us-west-1', 'us-west-2',
+]
+
+
+# Stands in for the Aws class, accepting metadata uploads without sending them anywhere
+class DiscardingMetadataBucket:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.num_uploads = 0
+
+    def get_s3_metadata_file(self, path):
+        return None
+
+    def upload_s3_metadata_file(self, path, body, cache_control, content_type='application/json'):
+        with self.lock:
+            self.num_uploads += 1
+
+    def delete_unreferenced_metadata_objects(self, referenced_keys):
+        return 0
+
+    def invalidate_metadata_cloudfront(self):
+        pass
+
+
+# Generates layer configs for a synthetic inventory, with every real layer definition
+# repeated scale times (as different packages) and published in every region
+def generate_synthetic_layer_configs(scale):
+    layer_definitions = layers.get_layer_definitions()
+    layer_configs = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for i in range(scale):
+            definitions = {f'{name}-{i}': definition for name, definition in layer_definitions.items()}
+            layer_configs |= layers.generate_layer_configs(definitions, directory)
+
+    for layer_config in layer_configs.values():
+        layer_config['regional'] = {
+            region: {
+                'Description': '{"df_sha256":"' + layer_config['dockerfile_sha256'] + '"}',
+                'LicenseInfo': Constants.LICENCE_URL,
+                'LayerArn': f'arn:aws:lambda:{region}:000000000000:layer:{layer_config['name']}',
+                'LayerVersionArn': f'arn:aws:lambda:{region}:000000000000:layer:{layer_config['name']}:1',
+                'Version': 1,
+                'CreatedDate': '2026-01-01T00:00:00.000+0000',
+                'LayerName': layer_config['name'],
+                'Content': {
+                    'SigningJobArn': f'arn:aws:signer:{Constants.PRIMARY_REGION}:000000000000:/signing-jobs/00000000-0000-0000-0000-000000000000',
+                    'SigningProfileVersionArn': f'arn:aws:signer:{Constants.PRIMARY_REGION}:000000000000:/signing-profiles/Profile/0000000000',
+                    'CodeSha256': layer_config['dockerfile_sha256'],
+                    'CodeSize': 12345678,
+                },
+            }
+            for region in REGIONS
+        }
+    return layer_configs
+
+
+# The previous approach, for comparison, as it was before documents were streamed: the metadata
+# tree is built with nested lookups, then a merged copy of every document is materialized in a
+# dict before any are uploaded, and each one is only encoded as it's uploaded
+def upload_materialized(aws, layer_configs):
+    metadata = {}
+    for layer_config in layer_configs.values():
+        if layer_config['package_name'] not in metadata:
+            metadata[layer_config['package_name']] = {}
+        if layer_config['version'] not in metadata[layer_config['package_name']]:
+            metadata[layer_config['package_name']
+                     ][layer_config['version']] = {}
+        if layer_config['runtime'] not in metadata[layer_config['package_name']][layer_config['version']]:
+            metadata[layer_config['package_name']][layer_config['version']
+                                                   ][layer_config['runtime']] = {}
+        if layer_config['architecture'] not in metadata[layer_config['package_name']][layer_config['version']][layer_config['runtime']]:
+            metadata[layer_config['package_name']][layer_config['version']
+                                                   ][layer_config['runtime']][layer_config['architecture']] = {}
+        for region, regional in layer_config['regional'].items():
+            metadata[layer_config['package_name']][layer_config['version']][layer_config['runtime']][layer_config['architecture']][region] = {
+                'description': regional['Description'],
+                'license_info': regional['LicenseInfo'],
+                'layer_arn': regional['LayerArn'],
+                'layer_version_arn': regional['LayerVersionArn'],
+                'layer_version': regional['Version'],
+                'created_date': regional['CreatedDate'],
+                'layer_name': regional['LayerName'],
+                'signing_job_arn': regional['Content'].get('SigningJobArn'),
+                'signing_profile_version_arn': regional['Content'].get('SigningProfileVersionArn'),
+                'source_code_hash': regional['Content']['CodeSha256'],
+                'source_code_size': regional['Content']['CodeSize']
+            }
+
+    metadata_files = {}
+    package_base_path = "packages"
+    for package_name, package_config in metadata.items():
+        metadata_files[str(uuid.uuid4())] = {
+            'path': f'{package_base_path}/{package_name}.json',
+            'metadata': package_config | {
+                'package': package_name,
+            }
+        }
+        for version, version_config in package_config.items():
+            metadata_files[str(uuid.uuid4())] = {
+                'path': f'{package_base_path}/{package_name}/{version}.json',
+                'metadata': version_config | {
+                    'package': package_name,
+                    'package_version': version,
+                }
+            }
+            for runtime, runtime_config in version_config.items():
+                metadata_files[str(uuid.uuid4())] = {
+                    'path': f'{package_base_path}/{package_name}/{version}/{runtime}.json',
+                    'metadata': runtime_config | {
+                        'package': package_name,
+                        'package_version': version,
+                        'runtime': runtime,
+                    }
+                }
+                for architecture, architecture_config in runtime_config.items():
+                    metadata_files[str(uuid.uuid4())] = {
+                        'path': f'{package_base_path}/{package_name}/{version}/{runtime}/{architecture}.json',
+                        'metadata': architecture_config | {
+                            'package': package_name,
+                            'package_version': version,
+                            'runtime': runtime,
+                            'architecture': architecture,
+                        }
+                    }
+                    for region, region_config in architecture_config.items():
+                        metadata_files[str(uuid.uuid4())] = {
+                            'path': f'{package_base_path}/{package_name}/{version}/{runtime}/{architecture}/{region}.json',
+                            'metadata': region_config | {
+                                'package': package_name,
+                                'package_version': version,
+                                'runtime': runtime,
+                                'architecture': architecture,
+                                'region': region,
+                            }
+                        }
+
+    metadata_files[str(uuid.uuid4())] = {
+        'path': Constants.METADATA_OBJECT,
+        'metadata': metadata
+    }
+
+    # The documents were encoded by the upload itself
+    def upload_s3_metadata_file(path, metadata):
+        aws.upload_s3_metadata_file(
+            path, json.dumps(metadata, separators=(',', ':')).encode(), None)
+
+    concurrent_func(
+        100, upload_s3_metadata_file, metadata_files, expand_input=True)
+
+
+# Measures the wall time and peak traced memory of a metadata upload function, and returns the peak
+def measure(name, upload_func, layer_configs):
+    aws = DiscardingMetadataBucket()
+    tracemalloc.start()
+    start = time.perf_counter()
+    upload_func(aws, layer_configs)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f'{name}: {aws.num_uploads} uploads in {elapsed:.2f} s, peak memory {peak / 1048576:.1f} MiB')
+    return peak
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Compares how the memory use of uploading metadata grows with the size of a synthetic inventory')
+    parser.add_argument('--scales', type=int, nargs='+', default=[1, 2, 5, 10],
+                        help='How many times larger than the current layer definitions each inventory should be')
+    args = parser.parse_args()
+
+    num_layers = []
+    peaks = {
+        'Materialized': [],
+        'Streaming': [],
+    }
+    for scale in args.scales:
+        layer_configs = generate_synthetic_layer_configs(scale)
+        print(f'Synthetic inventory at {scale}x: {len(layer_configs)} layers in {len(REGIONS)} regions')
+        num_layers.append(len(layer_configs))
+        peaks['Materialized'].append(measure('Materialized', upload_materialized, layer_configs))
+        peaks['Streaming'].append(measure('Streaming', build.upload_metadata, layer_configs))
+        del layer_configs
+
+    # Neither approach is flat: the metadata tree, the manifest and the whole layers.json and SQLite
+    # documents all grow with the inventory. The slope shows how much each layer adds to the peak.
+    if len(args.scales) > 1:
+        for name, name_peaks in peaks.items():
+            slope = statistics.linear_regression(num_layers, name_peaks).slope
+            print(f'{name}: peak memory grows by {slope / 1024:.1f} KiB per layer')
@@ -0,0 +1,79 @@
+import argparse
+import glob
+import json
+
+
+# Parses a shard specification of the form "i/N" (where i is from 1 to N) for argparse
+def parse_shard(spec):
+    try:
+        index, count = [int(part) for part in spec.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f'Shard must be of the form "i/N", not "{spec}"')
+    if count < 1 or index < 1 or index > count:
+        raise argparse.ArgumentTypeError(
+            f'Shard index must be between 1 and the number of shards, not "{spec}"')
+    return index, count
+
+
+# Deterministically partitions layers between shards. The layers that need to be built are
+# balanced by their historical build durations: they're assigned in descending order of cost
+# to the least-loaded shard, with ties broken by name and shard index. The remaining layers
+# only need their existing versions checked, so they're spread evenly by count. As long as
+# every shard is given the same inputs, every shard computes the same partition.
+def partition(layer_names, costs, layers_to_build, num_shards):
+    layer_names_to_build = [name for name in layer_names if name in layers_to_build]
+    known_costs = [costs[name] for name in layer_names_to_build if name in costs]
+    # Layers that have never been built are assumed to take an average amount of time
+    default_cost = sum(known_costs) / len(known_costs) if len(known_costs) > 0 else 1
+
+    shards = [[] for _ in range(num_shards)]
+    loads = [0] * num_shards
+    for name in sorted(layer_names_to_build, key=lambda name: (-costs.get(name, default_cost), name)):
+        shard_index = min(range(num_shards), key=lambda i: (loads[i], i))
+        shards[shard_index].append(name)
+        loads[shard_index] += costs.get(name, default_cost)
+    for name in sorted(name for name in layer_names if name not in layers_to_build):
+        shard_index = min(range(num_shards), key=lambda i: (len(shards[i]), i))
+        shards[shard_index].append(name)
+    return shards
+
+
+# Writes the results of a shard, so they can be merged once all shards are complete
+def write_shard_output(directory, index, count, layer_configs, failures, inventory_checks):
+    path = f'{directory}/shard-{index}-of-{count}.json'
+    with open(path, mode='w') as file:
+        json.dump({
+            'shard': index,
+            'num_shards': count,
+            'layer_configs': layer_configs,
+            'failures': failures,
+            'inventory_checks': inventory_checks,
+        }, file, default=str)
+    print(f'Shard results written to {path}')
+
+
+# Reads the results of all shards, and returns the combined layer configs, failures and inventory checks
+def read_shard_outputs(directory):
+    outputs = []
+    for filename in glob.glob(f'{directory}/**/shard-*-of-*.json', recursive=True):
+        with open(filename, mode='r') as file:
+            outputs.append(json.load(file))
+
+    if len(outputs) == 0:
+        raise ValueError(f'No shard results were found in {directory}')
+    num_shards = outputs[0]['num_shards']
+    found = sorted(output['shard'] for output in outputs)
+    if found != list(range(1, num_shards + 1)) or any(output['num_shards'] != num_shards for output in outputs):
+        raise ValueError(
+            f'Expected results for shards 1 to {num_shards}, but found results for shards {found}')
+
+    layer_configs = {}
+    failures = []
+    inventory_checks = {}
+    for output in outputs:
+        layer_configs |= output['layer_configs']
+        failures.extend(output['failures'])
+        for region, layer_checks in output['inventory_checks'].items():
+            inventory_checks.setdefault(region, {}).update(layer_checks)
+    return layer_configs, failures, inventory_checks